@@ -8,8 +8,12 @@ from languagemodels.inference import (
     rank_instruct,
     parse_chat,
     list_tokens,
-    load_artifacts_into_memory
+    load_artifacts_into_memory,
+    load_tokenizer,
+    load_encoder,
+    drop_oldest_turns
 )
+from languagemodels import embeddings
 
 
 def get_model_name() -> str:
@@ -36,7 +40,9 @@ def complete(prompt: str) -> str:
 
     result = generate(
         ["Write a sentence"], prefix=prompt,
-        max_tokens=config["max_tokens"], temperature=0.7, topk=40
+        max_tokens=config["max_output_tokens"],
+        max_input_tokens=config["max_input_tokens"],
+        temperature=0.7, topk=40
     )[0]
 
     if result.startswith(prompt):
@@ -75,11 +81,13 @@ def do(prompt: str) -> str:
     ...
 
 
-def do(prompt, choices=None, preloaded_artifacts=None):
+def do(prompt, choices=None, preloaded_artifacts=None, **kwargs):
     """Follow a single-turn instructional prompt
 
     :param prompt: Instructional prompt(s) to follow
     :param choices: If provided, outputs are restricted to values in choices
+    :param kwargs: Extra options passed to `generate` such as `should_stop`,
+    `return_partial` and `details`
     :return: Completion returned from the language model
 
     Note that this function is overloaded to return a list of results if
@@ -106,19 +114,14 @@ def do(prompt, choices=None, preloaded_artifacts=None):
 
     prompts = [prompt] if isinstance(prompt, str) else prompt
 
-    if not preloaded_artifacts:
-        if choices:
-            results = [r[0] for r in rank_instruct(prompts, choices)]
-        else:
-            results = generate(prompts,
-                               max_tokens=config["max_tokens"],
-                               topk=1)
-
-    else:
-        results = generate(prompts,
-                           max_tokens=config["max_tokens"],
-                           topk=1,
-                           preloaded_artifacts=preloaded_artifacts)
+    results = generate(prompts,
+                       max_tokens=config["max_output_tokens"],
+                       max_input_tokens=config["max_input_tokens"],
+                       topk=1,
+                       length_key="do",
+                       preloaded_artifacts=preloaded_artifacts,
+                       choices=choices,
+                       **kwargs)
 
     if not choices:
         results = _refine_response_punctuation(results)
@@ -126,7 +129,7 @@ def do(prompt, choices=None, preloaded_artifacts=None):
     return results[0] if isinstance(prompt, str) else results
 
 
-def chat(prompt: str, preloaded_artifacts=None) -> str:
+def chat(prompt: str, preloaded_artifacts=None, **kwargs) -> str:
     """Get new message from chat-optimized language model
 
     The `prompt` for this model is provided as a series of messages as a single
@@ -171,20 +174,21 @@ def chat(prompt: str, preloaded_artifacts=None) -> str:
     '...5:00pm...'
     """
     messages = parse_chat(prompt)
-    return _chat_from_dict(messages, preloaded_artifacts)
+    return _chat_from_dict(messages, preloaded_artifacts, **kwargs)
 
 
-def chat_from_dict(messages: dict, preloaded_artifacts=None) -> str:
+def chat_from_dict(messages: dict, preloaded_artifacts=None,
+                   **kwargs) -> str:
     """Get new message from chat-optimized language model
 
     This function is similar to chat() but requires the input
     to be already structured as a dictionary so that string
     parsing can be skipped.
     """
-    return _chat_from_dict(messages, preloaded_artifacts)
+    return _chat_from_dict(messages, preloaded_artifacts, **kwargs)
 
 
-def _chat_from_dict(messages: dict, preloaded_artifacts=None):
+def _chat_from_dict(messages: dict, preloaded_artifacts=None, **kwargs):
     """Business logic for chat() and chat_from_dict()"""
     # Suppress starts of all assistant messages to avoid repeat generation
     suppress = [
@@ -206,6 +210,15 @@ def _chat_from_dict(messages: dict, preloaded_artifacts=None):
     # Keep all system messages
     messages = system_msgs + assistant_msgs[-1:] + user_msgs[-1:]
 
+    # Dropping turns is only possible on messages so the remaining
+    # tokens are truncated from the head of the prompt
+    dropped_turn_tokens = 0
+    if kwargs.get("truncation") == "drop_oldest_turns":
+        messages, dropped_turn_tokens = drop_oldest_turns(
+            messages, load_tokenizer(preloaded_artifacts),
+            config["max_input_tokens"])
+        kwargs["truncation"] = "head"
+
     rolemap = {
         "system": "System",
         "user": "Question",
@@ -221,15 +234,21 @@ def _chat_from_dict(messages: dict, preloaded_artifacts=None):
 
     response = generate(
         [prompt],
-        max_tokens=config["max_tokens"],
+        max_tokens=config["max_output_tokens"],
+        max_input_tokens=config["max_input_tokens"],
+        length_key="chat",
         repetition_penalty=1.3,
         temperature=0.3,
         topk=40,
         prefix="Assistant:",
         suppress=suppress,
-        preloaded_artifacts=preloaded_artifacts
+        preloaded_artifacts=preloaded_artifacts,
+        **kwargs
     )[0]
 
+    if kwargs.get("details") is not None:
+        kwargs["details"]["dropped_tokens"][0] += dropped_turn_tokens
+
     # Remove duplicate assistant being generated
     if response.startswith("Assistant:"):
         response = response[10:]
@@ -237,7 +256,29 @@ def _chat_from_dict(messages: dict, preloaded_artifacts=None):
     return response.strip()
 
 
-def extract_answer(question: str, context: str) -> str:
+def embed(texts: list, preloaded_artifacts=None, **kwargs):
+    """Computes the sentence embeddings of texts
+
+    The encoder is run alone over batches of the texts and its outputs
+    are mean-pooled over the tokens of each text.
+
+    :param texts: Texts to embed
+    :param kwargs: Extra options passed to `embeddings.embed` such as
+    `truncation`, `should_stop` and `details`
+    :return: Array of shape (texts, hidden size)
+
+    Examples:
+
+    >>> embed(["Hello world", "Hola mundo"]).shape # doctest: +SKIP
+    (2, 768)
+    """
+    return embeddings.embed(texts, load_tokenizer(preloaded_artifacts),
+                            load_encoder(), config["max_input_tokens"],
+                            **kwargs)
+
+
+def extract_answer(question: str, context: str,
+                   preloaded_artifacts=None, **kwargs) -> str:
     """Extract an answer to a `question` from a provided `context`
 
     The returned answer will always be a substring extracted from `context`.
@@ -246,8 +287,13 @@ def extract_answer(question: str, context: str) -> str:
 
     :param question: A question to answer using knowledge from context
     :param context: Knowledge used to answer the question
+    :param kwargs: Extra options passed to `generate`
     :return: Answer to the question.
 
+    The context is passed separately from the question so that backends
+    able to cache it (i.e., decoder-only models) reuse it across
+    questions about the same context.
+
     Examples:
 
     >>> context = "There is a green ball and a red box"
@@ -256,7 +302,8 @@ def extract_answer(question: str, context: str) -> str:
     '...green...'
     """
 
-    return generate([f"{context}\n\n{question}"])[0]
+    return generate([question], context=context,
+                    preloaded_artifacts=preloaded_artifacts, **kwargs)[0]
 
 
 def classify(doc: str, label1: str, label2: str) -> str:
@@ -0,0 +1,140 @@
+"""Inference backends
+
+A backend is selected by the "backend" attribute of the bootstrap config
+and maps to a loader that builds the model from the artifact path. The
+functions in this module wrap the encoder-decoder (`Translator`) and
+decoder-only (`Generator`) interfaces of CTranslate2 so that decoding and
+scoring share the same code paths regardless of the model type.
+"""
+
+import os
+import ctranslate2
+import numpy as np
+
+from languagemodels.stub import StubEncoder, StubGenerator, StubTranslator
+
+
+class BackendException(Exception):
+    pass
+
+
+def _load_translator(artifact_dir, model_info, **options):
+    return ctranslate2.Translator(artifact_dir, "cpu",
+                                  compute_type=model_info["quantization"],
+                                  **options)
+
+
+def _load_generator(artifact_dir, model_info, **options):
+    return ctranslate2.Generator(artifact_dir, "cpu",
+                                 compute_type=model_info["quantization"],
+                                 **options)
+
+
+def _get_stub_options(model_info):
+    return {k[len("stub_"):]: v for k, v in model_info.items()
+            if k.startswith("stub_")}
+
+
+def _load_stub_translator(artifact_dir, model_info, **options):
+    return StubTranslator(**_get_stub_options(model_info))
+
+
+def _load_stub_generator(artifact_dir, model_info, **options):
+    return StubGenerator(**_get_stub_options(model_info))
+
+
+# Maps the backend name to a model loader that takes the artifact
+# path, the model info and the threading options of the backend
+# (i.e., "intra_threads" when the model is replicated)
+loaders = {
+    "translator": _load_translator,
+    "generator": _load_generator,
+    "stub": _load_stub_translator,
+    "stub_generator": _load_stub_generator,
+}
+
+
+def register_backend(name, loader):
+    """Registers a model loader for a backend name"""
+    loaders[name] = loader
+
+
+def load_model(artifact_dir, model_info, **options):
+    backend = model_info.get("backend", "translator")
+    if backend not in loaders:
+        raise BackendException(f"Unknown backend: {backend}")
+    return loaders[backend](artifact_dir, model_info, **options)
+
+
+def load_encoder(artifact_dir, model_info):
+    """Loads the encoder-only model used for embeddings
+
+    CTranslate2 does not expose the encoder of a Translator, so the
+    encoder has to be converted separately as an encoder-only model and
+    its path (relative to the artifacts) set as "encoder_model".
+    """
+    if model_info.get("backend", "translator").startswith("stub"):
+        return StubEncoder()
+    if not model_info.get("encoder_model"):
+        raise BackendException("Embeddings require an 'encoder_model' "
+                               "in the bootstrap config")
+    return ctranslate2.Encoder(
+        os.path.join(artifact_dir, model_info["encoder_model"]), "cpu",
+        compute_type=model_info["quantization"])
+
+
+def is_generator(model):
+    """Checks whether a model (or the replicas of a pool) is decoder-only"""
+    model = getattr(model, "replicas", [model])[0]
+    return "Generator" in type(model).__name__
+
+
+def generate_batch(model, source, target_prefix, max_decoding_length,
+                   static_prompt=None, cache_static_prompt=True, **options):
+    """Decodes a batch of tokenized prompts
+
+    For decoder-only models, the target prefix is appended to the prompt
+    and the model state after the optional `static_prompt` (e.g., the part
+    of the prompt format shared by all requests) is cached by the backend
+    across calls unless `cache_static_prompt` is false. It is prepended to
+    the source of encoder-decoder models instead.
+
+    Returns the best hypothesis of each prompt including the prefix.
+    """
+    if is_generator(model):
+        results = model.generate_batch(
+            [s + p for s, p in zip(source, target_prefix)],
+            max_length=max_decoding_length - min(map(len, target_prefix)),
+            static_prompt=static_prompt or None,
+            cache_static_prompt=cache_static_prompt,
+            include_prompt_in_result=False,
+            **options)
+        return [p + r.sequences[0] for p, r in zip(target_prefix, results)]
+
+    if static_prompt:
+        source = [static_prompt + s for s in source]
+    results = model.translate_batch(
+        source=source,
+        target_prefix=target_prefix,
+        max_decoding_length=max_decoding_length,
+        **options)
+    return [r.hypotheses[0] for r in results]
+
+
+def score_batch(model, source, target):
+    """Returns the log probabilities of each target given its source"""
+    if is_generator(model):
+        # Decoder-only models score the concatenated sequence and
+        # the log probabilities of the target are the last ones
+        results = model.score_batch([s + t for s, t in zip(source, target)])
+        return [r.log_probs[len(r.log_probs) - len(t):]
+                for r, t in zip(results, target)]
+    results = model.score_batch(source, target=target)
+    return [r.log_probs for r in results]
+
+
+def encode_batch(encoder, source):
+    """Returns the last hidden states of a batch of tokenized
+    sequences as an array of shape (batch, max length, hidden)"""
+    output = encoder.forward_batch(source)
+    return np.asarray(output.last_hidden_state)
@@ -0,0 +1,236 @@
+"""Offline batch inference over JSONL files
+
+Each line of the input holds a record with a "prompt" (completed as by
+`do`) or a list of chat "messages" (as by `chat_from_dict`) and an
+optional "id". The output holds one line per input record, in the same
+order, with its "id" (its line index by default) and a "completion" or
+the "error" that prevented it, e.g.:
+
+python -m languagemodels.batch prompts.jsonl completions.jsonl --resume
+
+Records are streamed in windows of `window_size`, so that memory does
+not depend on the size of the input. The next window is read and
+tokenized in a worker thread whilst the model runs on the current one,
+whose prompts are sorted by token count and decoded in batches of
+`batch_size` so that little compute is spent on padding. The token
+counts are only used for sorting: `do` tokenizes the prompts again. Chats are
+completed one at a time since each one carries its own suppressed
+sequences.
+
+Each window is written and flushed to disk as a whole, so the output
+doubles as the checkpoint: with `resume`, the records already in the
+output are skipped (and a partially written last line is dropped).
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+import languagemodels as lm
+
+from concurrent.futures import ThreadPoolExecutor
+from languagemodels.inference import TRUNCATION_MODES
+
+
+log = logging.getLogger(__name__)
+
+BATCH_SIZE = 32
+WINDOW_SIZE = 1024
+
+
+def read_records(path, skip=0):
+    """Yields the index and record of each non-empty line of a JSONL
+    file after the first `skip` ones. Invalid lines yield an error."""
+    with open(path) as f:
+        lines = (line for line in f if line.strip())
+        for index, line in enumerate(itertools.islice(lines, skip, None),
+                                     start=skip):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                record = {"error": f"Invalid JSON: {e}"}
+            if not isinstance(record, dict):
+                record = {"error": "Record is not a JSON object"}
+            yield index, record
+
+
+def count_completed(path):
+    """Returns the number of records written to an output file,
+    truncating a partially written last line"""
+    if not os.path.exists(path):
+        return 0
+    count, end = 0, 0
+    with open(path, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            count += 1
+            end += len(line)
+        f.truncate(end)
+    return count
+
+
+def _tokenize(tokenizer, window):
+    """Returns the window with the token count of each prompt"""
+    prompts = [i for i, (_, r) in enumerate(window)
+               if isinstance(r.get("prompt"), str)]
+    lengths = [0] * len(window)
+    encodings = tokenizer.encode_batch([window[i][1]["prompt"]
+                                        for i in prompts])
+    for i, e in zip(prompts, encodings):
+        lengths[i] = len(e.ids)
+    return window, lengths
+
+
+def _read_window(records, tokenizer, window_size):
+    return _tokenize(tokenizer, list(itertools.islice(records, window_size)))
+
+
+class Progress:
+    """Counts processed records and decoded tokens, and logs
+    the throughput since the start of the run"""
+
+    def __init__(self, skipped=0):
+        self.skipped = skipped
+        self.records = 0
+        self.tokens = 0
+        self.errors = 0
+        self.start = time.perf_counter()
+
+    def update(self, results, tokens):
+        self.records += len(results)
+        self.errors += sum("error" in r for r in results)
+        self.tokens += tokens
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        log.info(f"{self.skipped + self.records} records done "
+                 f"({self.errors} errors) - "
+                 f"{self.records / elapsed:.1f} records/s, "
+                 f"{self.tokens / elapsed:.1f} tokens/s")
+
+
+def _complete_prompts(prompts, artifacts, options):
+    """Completes a batch of prompts, falling back to one prompt
+    at a time if the batch fails (e.g., a prompt is too long)"""
+    details = {}
+    try:
+        completions = lm.do(list(prompts), preloaded_artifacts=artifacts,
+                            details=details, **options)
+        return ([{"completion": c} for c in completions],
+                sum(details["output_tokens"]))
+    except Exception as e:
+        if len(prompts) == 1:
+            return [{"error": str(e)}], 0
+    results, tokens = [], 0
+    for prompt in prompts:
+        result, n = _complete_prompts([prompt], artifacts, options)
+        results += result
+        tokens += n
+    return results, tokens
+
+
+def _complete_chat(messages, artifacts, options):
+    details = {}
+    try:
+        completion = lm.chat_from_dict(messages, preloaded_artifacts=artifacts,
+                                       details=details, **options)
+        return {"completion": completion}, sum(details["output_tokens"])
+    except Exception as e:
+        return {"error": str(e)}, 0
+
+
+def process_window(window, lengths, artifacts, batch_size, options):
+    """Returns the results of a window of records in input order
+    and the number of tokens decoded for them"""
+    results = [None] * len(window)
+    prompts, tokens = [], 0
+    for i, (_, record) in enumerate(window):
+        if "error" in record:
+            results[i] = {"error": record["error"]}
+        elif isinstance(record.get("prompt"), str):
+            prompts.append(i)
+        elif isinstance(record.get("messages"), list):
+            results[i], n = _complete_chat(record["messages"], artifacts,
+                                           options)
+            tokens += n
+        else:
+            results[i] = {"error": "Record needs a 'prompt' string "
+                                   "or a list of 'messages'"}
+
+    prompts.sort(key=lengths.__getitem__)
+    for start in range(0, len(prompts), batch_size):
+        batch = prompts[start:start + batch_size]
+        batch_results, n = _complete_prompts(
+            [window[i][1]["prompt"] for i in batch], artifacts, options)
+        for i, result in zip(batch, batch_results):
+            results[i] = result
+        tokens += n
+
+    return [dict(id=record.get("id", index), **result)
+            for (index, record), result in zip(window, results)], tokens
+
+
+def run(input_path, output_path, batch_size=BATCH_SIZE,
+        window_size=WINDOW_SIZE, resume=False, preloaded_artifacts=None,
+        **options):
+    """Completes the records of a JSONL file into another one
+
+    Extra options (e.g., `truncation`) are passed to `generate`.
+    Returns the Progress of the run.
+    """
+    skip = count_completed(output_path) if resume else 0
+    artifacts = preloaded_artifacts or lm.get_preloaded_artifacts()
+    records = read_records(input_path, skip)
+    progress = Progress(skip)
+    if skip:
+        log.info(f"Resuming after {skip} records")
+
+    with open(output_path, "a" if resume else "w") as out, \
+            ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(_read_window, records, artifacts[0],
+                              window_size)
+        while True:
+            window, lengths = pending.result()
+            if not window:
+                break
+            pending = pool.submit(_read_window, records, artifacts[0],
+                                  window_size)
+            results, tokens = process_window(window, lengths, artifacts,
+                                             batch_size, options)
+            out.writelines(json.dumps(r) + "\n" for r in results)
+            out.flush()
+            os.fsync(out.fileno())
+            progress.update(results, tokens)
+            progress.report()
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m languagemodels.batch",
+        description="Completes the prompts or chats of a JSONL file")
+    parser.add_argument("input", help="JSONL file of records with a "
+                        "'prompt' or 'messages' and an optional 'id'")
+    parser.add_argument("output", help="JSONL file of completions")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--window-size", type=int, default=WINDOW_SIZE,
+                        help="Records read into memory at once")
+    parser.add_argument("--truncation", choices=TRUNCATION_MODES,
+                        help="Truncates prompts over the input token limit "
+                        "instead of failing them")
+    parser.add_argument("--resume", action="store_true",
+                        help="Skips the records already in the output")
+    args = parser.parse_args(argv)
+
+    options = {"truncation": args.truncation} if args.truncation else {}
+    progress = run(args.input, args.output, args.batch_size,
+                   args.window_size, args.resume, **options)
+    return 1 if progress.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
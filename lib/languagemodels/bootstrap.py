@@ -2,11 +2,27 @@ import os
 import json
 
 
+# Used when the stub backend runs without any model artifacts
+STUB_BOOTSTRAP_CONFIG = {
+    "name": "stub",
+    "params": 248e6,
+    "quantization": "int8",
+    "max_tokens": 250,
+    "backend": "stub"
+}
+
+
 class ModelLoadException(Exception):
     pass
 
 
+def get_backend_from_env():
+    return os.environ.get("LLM_BACKEND")
+
+
 def get_artifact_dir():
+    if get_backend_from_env() == "stub":
+        return os.environ.get("LLM_ARTIFACT_DIR") or None
     return _get_artifact_dir_from_env()
 
 
@@ -20,6 +36,14 @@ def _get_artifact_dir_from_env():
 
 
 def load_bootstrap_config():
-    artifact_dir = _get_artifact_dir_from_env()
+    """Loads the bootstrap config of the model artifacts. The
+    backend can be overridden by the variable 'LLM_BACKEND', and
+    the stub backend can run without any artifacts."""
+    artifact_dir = get_artifact_dir()
+    if artifact_dir is None:
+        return dict(STUB_BOOTSTRAP_CONFIG)
     with open(f"{artifact_dir}/bootstrap_config.json", "r") as f:
-        return json.load(f)
+        bootstrap_config = json.load(f)
+    if get_backend_from_env():
+        bootstrap_config["backend"] = get_backend_from_env()
+    return bootstrap_config
@@ -0,0 +1,73 @@
+"""Adaptive output token budgets
+
+Completion lengths observed for each endpoint or prompt template are
+tracked in a bounded window, and a high percentile of that window is
+used to cap `max_decoding_length`. Runaway generations (e.g., repetition
+loops) are therefore stopped well before the static `max_output_tokens`
+limit, which also bounds the number of decoding steps of a whole batch.
+"""
+
+import math
+import threading
+
+from collections import deque
+
+
+class CompletionLengthTracker:
+    """Tracks completion lengths per key and derives an output cap
+
+    >>> tracker = CompletionLengthTracker(min_samples=3, headroom=1.5)
+    >>> tracker.cap("do", 200)
+    200
+    >>> for length in [10, 12, 20]:
+    ...     tracker.observe("do", length)
+    >>> tracker.cap("do", 200)
+    30
+    >>> tracker.cap("do", 25)
+    25
+    """
+
+    def __init__(self, percentile=0.99, window=1000, min_samples=50,
+                 headroom=1.5, min_cap=16):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.min_cap = min_cap
+        self._lengths = dict()
+        self._caps = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, key, length):
+        with self._lock:
+            lengths = self._lengths.setdefault(
+                key, deque(maxlen=self.window))
+            lengths.append(length)
+            self._caps.pop(key, None)
+
+    def _quantile(self, key):
+        lengths = sorted(self._lengths.get(key, []))
+        if len(lengths) < self.min_samples:
+            return None
+        index = math.ceil(self.percentile * len(lengths)) - 1
+        return lengths[max(index, 0)]
+
+    def quantile(self, key):
+        """Returns the tracked percentile of the
+        lengths observed for key, or None"""
+        with self._lock:
+            return self._quantile(key)
+
+    def cap(self, key, max_tokens):
+        """Returns the output cap for key, never above max_tokens"""
+        with self._lock:
+            if key not in self._caps:
+                q = self._quantile(key)
+                if q is None:
+                    return max_tokens
+                self._caps[key] = max(self.min_cap,
+                                      math.ceil(q * self.headroom))
+            return min(max_tokens, self._caps[key])
+
+
+completion_lengths = CompletionLengthTracker()
@@ -13,6 +13,7 @@ import re
 import os
 
 from collections import namedtuple
+from telemetry import startup
 from languagemodels.bootstrap import load_bootstrap_config
 
 ConfigItem = namedtuple("ConfigItem", "initfn default")
@@ -90,6 +91,23 @@ class Config(dict):
         assert device in ["auto", "cpu"]
         return device
 
+    @staticmethod
+    def convert_to_bool(value):
+        """Convert a flag to bool
+
+        >>> Config.convert_to_bool("true")
+        True
+
+        >>> Config.convert_to_bool("0")
+        False
+
+        >>> Config.convert_to_bool(1)
+        True
+        """
+        if isinstance(value, str):
+            return value.lower().strip() in ("1", "true", "yes", "on")
+        return bool(value)
+
     @staticmethod
     def convert_to_gb(space):
         """Convert max RAM string to int
@@ -158,12 +176,19 @@ class Config(dict):
 
 
 # Load the bootstrap config for the model passed via env var
-models = [load_bootstrap_config()]
+with startup.phase("config"):
+    models = [load_bootstrap_config()]
 model_name = models[0]["name"]
 
 Config.schema = {
     "max_ram": ConfigItem(Config.convert_to_gb, 0.48),
     "max_tokens": ConfigItem(int, 200),
+    "max_input_tokens": ConfigItem(int, 200),
+    "max_output_tokens": ConfigItem(int, 200),
+    "adaptive_output_tokens": ConfigItem(Config.convert_to_bool, False),
+    "stop_repetition_loops": ConfigItem(Config.convert_to_bool, False),
+    "encoder_cache_bytes": ConfigItem(int, 0),
+    "cpu_replicas": ConfigItem(int, 0),
     "device": ConfigItem(Config.validate_device, "cpu"),
     "model_license": ConfigItem(re.compile, ".*")
 }
@@ -175,7 +200,13 @@ for k in models[0]:
     if k in Config.schema:
         Config.schema[k] = ConfigItem(Config.schema[k].initfn, models[0][k])
 
-config = Config()
+# Input and output budgets fall back to the shared max_tokens
+for k in ["max_input_tokens", "max_output_tokens"]:
+    if k not in models[0]:
+        Config.schema[k] = ConfigItem(int, Config.schema["max_tokens"].default)
+
+with startup.phase("config"):
+    config = Config()
 
 if "COLAB_GPU" in os.environ:
     if len(os.environ["COLAB_GPU"]) > 0:
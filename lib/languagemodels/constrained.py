@@ -0,0 +1,115 @@
+"""Decoding constrained to a set of choices
+
+The tokenized choices are stored in a prefix trie, and decoding walks
+the trie greedily: at a node with several children, the model scores
+the next token of each child (or the end of sequence when a choice ends
+there) and the most likely one is followed. Nodes with a single child
+need no model call, and the walk exits early once a single choice is
+left below the current node, so the cost depends on the number of
+branching points on the path rather than on the number of choices.
+
+The branching points of all the prompts of a batch are scored together
+in a single `score_batch` call per decoding step.
+
+>>> trie = TokenTrie([["▁red"], ["▁red", "▁wine"], ["▁blue"]])
+>>> trie.root.leaves
+3
+>>> sorted(trie.root.children)
+['▁blue', '▁red']
+>>> trie.root.children["▁blue"].leaves
+1
+"""
+
+from languagemodels import backends
+
+
+END_TOKEN = "</s>"
+
+
+class TrieNode:
+    __slots__ = ("children", "choice", "leaves")
+
+    def __init__(self):
+        self.children = {}
+        # Index of the choice ending at this node, if any
+        self.choice = None
+        self.leaves = 0
+
+
+class TokenTrie:
+    """Prefix trie of tokenized choices"""
+
+    def __init__(self, choices_tokens):
+        self.root = TrieNode()
+        for index, tokens in enumerate(choices_tokens):
+            self._insert(index, tokens)
+
+    def _insert(self, index, tokens):
+        node = self.root
+        path = [node]
+        for token in tokens:
+            node = node.children.setdefault(token, TrieNode())
+            path.append(node)
+        if node.choice is not None:
+            # Duplicated choices resolve to the first one
+            return
+        node.choice = index
+        for n in path:
+            n.leaves += 1
+
+
+def _single_leaf(node):
+    """Follows the only path of a node with a single choice below"""
+    while node.choice is None:
+        node = next(n for n in node.children.values() if n.leaves)
+    return node.choice
+
+
+def decode_choices(model, sources, trie, should_stop=None):
+    """Returns the index of the choice decoded for each tokenized source
+
+    Every step scores the candidate next tokens of the prompts that are
+    at a branching node, where the end of a choice is scored as the end
+    of sequence token.
+
+    `should_stop` is polled before every step and once it returns True,
+    the sources still undecided get None instead of a choice index.
+    """
+    nodes = [trie.root] * len(sources)
+    prefixes = [[] for _ in sources]
+    results = [None] * len(sources)
+    while True:
+        rows, candidates = [], []
+        for i, node in enumerate(nodes):
+            if results[i] is not None:
+                continue
+            while node.choice is None and len(node.children) == 1:
+                token, node = next(iter(node.children.items()))
+                prefixes[i].append(token)
+            nodes[i] = node
+            if node.leaves == 1:
+                results[i] = _single_leaf(node)
+                continue
+            options = list(node.children.items())
+            if node.choice is not None:
+                options.append((END_TOKEN, None))
+            candidates.append((i, options))
+            rows += [(i, token) for token, _ in options]
+        if not rows or should_stop and should_stop():
+            return results
+
+        log_probs = backends.score_batch(
+            model, [sources[i] for i, _ in rows],
+            [prefixes[i] + [token] for i, token in rows])
+        row = 0
+        for i, options in candidates:
+            # The next token is the last one of each target
+            scores = [log_probs[row + j][len(prefixes[i])]
+                      for j in range(len(options))]
+            row += len(options)
+            token, child = options[scores.index(max(scores))]
+            if child is None:
+                results[i] = nodes[i].choice
+            else:
+                nodes[i] = child
+                prefixes[i].append(token)
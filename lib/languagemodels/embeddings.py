@@ -0,0 +1,115 @@
+"""Sentence embeddings from the encoder
+
+The texts are tokenized, sorted by length and encoded in sub-batches
+whose padded size is capped, so that little compute is spent on padding.
+The last hidden states are mean-pooled over the tokens of each text,
+and the pooled vectors are kept in the encoder output cache (when
+enabled) so that repeated texts, such as shared context documents, are
+not re-encoded.
+
+>>> hidden = np.array([[[1., 2.], [3., 4.]], [[5., 6.], [0., 0.]]])
+>>> mean_pool(hidden, [2, 1])
+array([[2., 3.],
+       [5., 6.]])
+
+>>> vectors, scales = quantize(np.array([[0.5, -1.0]]), "int8")
+>>> vectors, scales
+(array([[  64, -127]], dtype=int8), array([0.00787402]))
+"""
+
+import time
+import numpy as np
+
+from languagemodels import backends
+from languagemodels.encoder_cache import encoder_outputs
+from languagemodels.inference import DeadlineExceededException
+from languagemodels.inference import MaxTokensException
+from languagemodels.inference import truncate_tokens
+
+
+PRECISIONS = ["float32", "float16", "int8"]
+# Upper bound on the padded tokens of an encoding batch
+MAX_BATCH_TOKENS = 8192
+
+
+def mean_pool(hidden, lengths):
+    """Averages the hidden states of the first `length` tokens
+    of each sequence"""
+    lengths = np.asarray(lengths)
+    mask = np.arange(hidden.shape[1]) < lengths[:, None]
+    summed = (hidden * mask[:, :, None]).sum(axis=1)
+    return summed / np.maximum(lengths, 1)[:, None]
+
+
+def quantize(vectors, precision):
+    """Casts vectors to a smaller precision to shrink payloads
+
+    Returns the vectors and, for int8, the scale of each vector
+    such that `vectors * scales` approximates the original ones.
+    """
+    if precision == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales
+    return vectors.astype(precision), None
+
+
+def _iter_batches(order, lengths, max_batch_tokens):
+    batch = []
+    for i in order:
+        # Sequences are sorted so the last one is the longest
+        if batch and (len(batch) + 1) * lengths[i] > max_batch_tokens:
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def embed(texts, tokenizer, encoder, max_input_tokens, truncation=None,
+          should_stop=None, details=None, max_batch_tokens=MAX_BATCH_TOKENS):
+    """Returns the mean-pooled embeddings of texts as a float32 array
+
+    Texts over `max_input_tokens` raise a MaxTokensException unless a
+    `truncation` mode is set. If a `details` dict is provided, it is
+    populated with the number of tokens of each text.
+    """
+    tokens = []
+    for e in tokenizer.encode_batch(texts):
+        t = e.tokens
+        if truncation:
+            t, _ = truncate_tokens(t, e.special_tokens_mask,
+                                   max_input_tokens, truncation)
+        if len(t) > max_input_tokens:
+            raise MaxTokensException("Input contains more tokens than "
+                                     f"allowed (got {len(t)} tokens "
+                                     f"whilst {max_input_tokens} tokens "
+                                     "is the limit)")
+        tokens.append(t)
+
+    lengths = [len(t) for t in tokens]
+    pooled = [None] * len(tokens)
+    if encoder_outputs.max_bytes:
+        for i, t in enumerate(tokens):
+            pooled[i] = encoder_outputs.get(tuple(t))
+
+    order = sorted((i for i in range(len(tokens)) if pooled[i] is None),
+                   key=lengths.__getitem__)
+    for batch in _iter_batches(order, lengths, max_batch_tokens):
+        if should_stop and should_stop():
+            raise DeadlineExceededException("Request was cancelled "
+                                            "during encoding")
+        start = time.perf_counter()
+        hidden = backends.encode_batch(encoder, [tokens[i] for i in batch])
+        seconds = (time.perf_counter() - start) / len(batch)
+        vectors = mean_pool(hidden, [lengths[i] for i in batch])
+        for i, vector in zip(batch, vectors):
+            pooled[i] = vector
+            if encoder_outputs.max_bytes:
+                encoder_outputs.put(tuple(tokens[i]), vector.copy(), seconds)
+    vectors = np.array(pooled, dtype=np.float32)
+
+    if details is not None:
+        details["tokens"] = lengths
+    return vectors
@@ -0,0 +1,68 @@
+"""Cache of pooled encoder outputs
+
+The mean-pooled outputs of the encoder for a sequence (one vector of
+the hidden size) are stored by their token ids and evicted in LRU order
+once their total size exceeds `max_bytes`. The time it took to encode
+each cached sequence is credited to the metric
+`encoder_cache_saved_seconds_total` every time it is reused.
+
+Only embeddings use the cache: CTranslate2 runs the encoder of a
+translator within `translate_batch`, so decoding cannot reuse it.
+
+>>> import numpy as np
+>>> cache = EncoderCache(max_bytes=32)
+>>> cache.put(("▁Hello", "</s>"), np.zeros(4, np.float32), 0.5)
+>>> cache.get(("▁Hello", "</s>")).shape
+(4,)
+>>> cache.put(("▁world", "</s>"), np.zeros(4, np.float32), 0.5)
+>>> cache.size_bytes
+32
+>>> cache.put(("▁Hi", "</s>"), np.zeros(4, np.float32), 0.5)
+>>> cache.get(("▁Hello", "</s>")) is None
+True
+"""
+
+import threading
+
+from collections import OrderedDict
+from telemetry import metrics
+from languagemodels.config import config
+
+
+class EncoderCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the outputs of the token ids `key` or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                metrics.increment("encoder_cache_misses_total")
+                return None
+            self._entries.move_to_end(key)
+        outputs, seconds = entry
+        metrics.increment("encoder_cache_hits_total")
+        metrics.increment("encoder_cache_saved_seconds_total", seconds)
+        return outputs
+
+    def put(self, key, outputs, seconds):
+        """Stores outputs that took `seconds` to encode"""
+        if outputs.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self._entries.pop(key)[0].nbytes
+            self._entries[key] = (outputs, seconds)
+            self.size_bytes += outputs.nbytes
+            while self.size_bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted.nbytes
+            metrics.set_gauge("encoder_cache_bytes", self.size_bytes)
+
+
+# Disabled unless "encoder_cache_bytes" is set
+encoder_outputs = EncoderCache(config["encoder_cache_bytes"])
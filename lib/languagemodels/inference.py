@@ -1,9 +1,19 @@
 import re
 import os
+import time
 import logging
 
-from typing import List
+from typing import Callable, List
+from telemetry import metrics
+from languagemodels import backends
+from languagemodels import scoring
+from telemetry import tracing
+from languagemodels.budget import completion_lengths
+from languagemodels.constrained import TokenTrie, decode_choices
+from languagemodels.repetition import LoopDetector, trim_loop
+from languagemodels.config import config
 from languagemodels.models import get_artifacts, get_model_info
+from languagemodels.models import get_encoder, get_tokenizer
 from languagemodels.bootstrap import get_artifact_dir
 
 
@@ -27,12 +37,120 @@ class InvalidTokenException(Exception):
     pass
 
 
+class DeadlineExceededException(Exception):
+    pass
+
+
+TRUNCATION_MODES = ["head", "tail", "middle"]
+
+
 def load_artifacts_into_memory(model_info):
     """Returns the preloaded tokenizer and model as a tuple."""
     artifact_dir = get_artifact_dir()
     return get_artifacts(artifact_dir, model_info)
 
 
+def load_tokenizer(preloaded_artifacts=None):
+    """Returns the preloaded tokenizer or loads it from the artifacts."""
+    if preloaded_artifacts:
+        return preloaded_artifacts[0]
+    return get_tokenizer(get_artifact_dir())
+
+
+def load_encoder():
+    """Returns the encoder used for embeddings, loading it once."""
+    try:
+        return get_encoder(get_artifact_dir(), get_model_info())
+    except backends.BackendException as e:
+        raise InferenceException(e)
+
+
+def _strip_trailing_special_tokens(encoding):
+    tokens = list(encoding.tokens)
+    mask = list(encoding.special_tokens_mask)
+    while mask and mask[-1]:
+        tokens.pop()
+        mask.pop()
+    return tokens
+
+
+def truncate_tokens(tokens, special_tokens_mask, max_length, mode):
+    """Truncates tokens to max_length whilst keeping special tokens
+
+    The mode names the part of the sequence that is removed: "head"
+    drops the first tokens, "tail" drops the last tokens and "middle"
+    drops tokens from the middle outwards. Special tokens at either end
+    of the sequence (e.g., the end of sequence token) are kept.
+
+    Returns the truncated tokens and the number of dropped tokens.
+
+    >>> tokens, mask = list("abcdef") + ["</s>"], [0] * 6 + [1]
+    >>> truncate_tokens(tokens, mask, 5, "head")
+    (['c', 'd', 'e', 'f', '</s>'], 2)
+
+    >>> truncate_tokens(tokens, mask, 5, "tail")
+    (['a', 'b', 'c', 'd', '</s>'], 2)
+
+    >>> truncate_tokens(tokens, mask, 4, "middle")
+    (['a', 'b', 'f', '</s>'], 3)
+
+    >>> truncate_tokens(tokens, mask, 10, "middle")
+    (['a', 'b', 'c', 'd', 'e', 'f', '</s>'], 0)
+    """
+    dropped = len(tokens) - max_length
+    if dropped <= 0:
+        return tokens, 0
+    if mode not in TRUNCATION_MODES:
+        raise InferenceException(f"Invalid truncation mode: {mode}")
+
+    start, end = 0, len(tokens)
+    while start < end and special_tokens_mask[start]:
+        start += 1
+    while end > start and special_tokens_mask[end - 1]:
+        end -= 1
+    keep = end - start - dropped
+    if keep <= 0:
+        raise MaxTokensException("Input cannot be truncated to "
+                                 f"{max_length} tokens")
+
+    if mode == "head":
+        body = tokens[end - keep:end]
+    elif mode == "tail":
+        body = tokens[start:start + keep]
+    else:
+        head = (keep + 1) // 2
+        body = tokens[start:start + head] + tokens[end - keep + head:end]
+    return tokens[:start] + body + tokens[end:], dropped
+
+
+def drop_oldest_turns(messages, tokenizer, max_tokens):
+    """Drops the oldest chat messages until the others fit in max_tokens
+
+    The last message is always kept, and system messages are only dropped
+    once all the other turns were dropped. Token counts are computed in
+    a single batched encoding pass.
+
+    Returns the remaining messages and the number of dropped tokens.
+    """
+    encodings = tokenizer.encode_batch([m["content"] for m in messages],
+                                       add_special_tokens=False)
+    lengths = [len(e.ids) for e in encodings]
+    candidates = [i for i, m in enumerate(messages[:-1])
+                  if m["role"] != "system"]
+    candidates += [i for i, m in enumerate(messages[:-1])
+                   if m["role"] == "system"]
+
+    dropped, total = set(), sum(lengths)
+    for i in candidates:
+        if total <= max_tokens:
+            break
+        dropped.add(i)
+        total -= lengths[i]
+
+    remaining = [m for i, m in enumerate(messages) if i not in dropped]
+    return remaining, sum(lengths[i] for i in dropped)
+
+
 def generate(
     instructions: List[str],
     max_tokens: int = 200,
@@ -41,13 +159,60 @@ def generate(
     repetition_penalty: float = 1.3,
     prefix: str = "",
     suppress: List[str] = [],
-    preloaded_artifacts: tuple = None
+    preloaded_artifacts: tuple = None,
+    should_stop: Callable[[], bool] = None,
+    return_partial: bool = False,
+    details: dict = None,
+    max_input_tokens: int = None,
+    length_key: str = None,
+    truncation: str = None,
+    choices: List[str] = None,
+    context: str = None
 ):
     """Generates completions for a prompt
 
     This may use a local model, or it may make an API call to an external
     model if API keys are available.
 
+    If `should_stop` is provided, it is polled before inference and after
+    every decoded token so that generation is aborted once it returns
+    True (e.g., a deadline passed or the client disconnected). Aborted
+    generations raise a DeadlineExceededException unless `return_partial`
+    is set, in which case the tokens decoded so far are returned.
+
+    If the `stop_repetition_loops` setting is enabled, sequences that
+    start repeating themselves (see `languagemodels.repetition`) stop
+    decoding early with a single copy of the repeated tokens and the
+    "repetition" finish reason.
+
+    If a `details` dict is provided, it is populated with the finish
+    reason and the number of decoded tokens of each completion, the
+    decoding parameters and the seconds spent in tokenization, inference
+    and detokenization.
+
+    `max_tokens` limits the decoded tokens and `max_input_tokens` limits
+    the prompt tokens (defaulting to `max_tokens`). When a `length_key`
+    naming the endpoint or prompt template is provided and the
+    `adaptive_output_tokens` setting is enabled, the decoding length is
+    further capped from the completion lengths observed for that key.
+
+    Prompts over `max_input_tokens` raise a MaxTokensException unless a
+    `truncation` mode is set (see `truncate_tokens`), in which case the
+    number of dropped tokens per prompt is reported in `details`.
+
+    If `choices` are provided, decoding is constrained to return one of
+    them for each prompt (see `languagemodels.constrained`). Prompts whose
+    choice is still undecided when `should_stop` returns True are
+    cancelled like generations, completing to an empty string when
+    `return_partial` is set.
+
+    A `context` shared by all the prompts (e.g., a document that several
+    questions refer to) precedes each instruction. For decoder-only
+    models it is passed as part of the static prompt, so its model state
+    is computed once for all the prompts of the call. Unlike the prompt
+    format, it is not cached by the backend across calls.
+    Its tokens count towards `max_input_tokens`.
+
     >>> generate(["What is the capital of France?"])
     ... # doctest: +ELLIPSIS
     ['...Paris...']
@@ -72,42 +237,186 @@ def generate(
         for str_list in [instructions, suppress]:
             for i in range(len(str_list)):
                 str_list[i] = str_list[i].replace(target, replacement)
+        if context:
+            context = context.replace(target, replacement)
 
+    start = time.perf_counter()
     suppress = [tokenizer.encode(s, add_special_tokens=False).tokens
                 for s in suppress]
     fmt = model_info.get("prompt_fmt", "{instruction}")
+    static_prompt, add_special_tokens = None, True
+    context_length = 0
+    if backends.is_generator(model) and (
+            context or not fmt.startswith("{instruction}")):
+        # The prompt format before the instruction and the context are
+        # shared by all the prompts. The model state after the format is
+        # cached by the backend, but not after a context specific to this
+        # request, which would grow the cache without bound
+        head, tail = fmt.split("{instruction}", 1)
+        static_prompt = _strip_trailing_special_tokens(tokenizer.encode(head))
+        if context:
+            static_prompt = _strip_trailing_special_tokens(
+                tokenizer.encode(f"{head}{context}\n\n"))
+            context_length = len(static_prompt)
+        fmt, add_special_tokens = "{instruction}" + tail, False
+    elif context:
+        instructions = [f"{context}\n\n{inst}" for inst in instructions]
     prompts = [fmt.replace("{instruction}", inst)
                for inst in instructions]
 
     outputs_ids = []
     prefix = tokenizer.encode(prefix, add_special_tokens=False).tokens
-    tokens = [tokenizer.encode(p).tokens for p in prompts]
-
-    len_tokens = len(tokens[0])
-    if len_tokens > max_tokens:
+    encodings = [tokenizer.encode(p, add_special_tokens=add_special_tokens)
+                 for p in prompts]
+    tokens = [e.tokens for e in encodings]
+
+    if max_input_tokens is None:
+        max_input_tokens = max_tokens
+    dropped_tokens = [0] * len(tokens)
+    if truncation:
+        for i, e in enumerate(encodings):
+            tokens[i], dropped_tokens[i] = truncate_tokens(
+                tokens[i], e.special_tokens_mask,
+                max_input_tokens - context_length, truncation)
+    len_tokens = max(len(t) for t in tokens) + context_length
+    if len_tokens > max_input_tokens:
         raise MaxTokensException("Input contains more tokens than allowed "
                                  f"(got {len_tokens} tokens whilst "
-                                 f"{max_tokens} tokens is the limit)")
+                                 f"{max_input_tokens} tokens is the limit)")
+
+    max_decoding_length = max_tokens
+    if length_key and config["adaptive_output_tokens"]:
+        max_decoding_length = completion_lengths.cap(length_key, max_tokens)
+        metrics.set_gauge("adaptive_output_cap", max_decoding_length,
+                          key=length_key)
+
+    cancelled = set()
+    loops = None
+    if config["stop_repetition_loops"]:
+        loops = LoopDetector(len(tokens))
+    # Translators also report the tokens of the target prefix as steps,
+    # whilst generators get the prefix as part of their prompt
+    prefix_steps = 0 if backends.is_generator(model) else len(prefix)
+
+    def stop_callback(step):
+        if should_stop and should_stop():
+            cancelled.add(step.batch_id)
+            return True
+        if loops is None or step.step < prefix_steps:
+            return False
+        return loops.update(step.batch_id, step.token)
+
+    callback = stop_callback if should_stop or loops is not None else None
+
+    if should_stop and should_stop():
+        raise DeadlineExceededException("Request was cancelled "
+                                        "before inference started")
+
+    tokenized = time.perf_counter()
+    if choices:
+        # Choices continue the prefix like any decoded output
+        trie = TokenTrie([prefix + tokenizer.encode(
+            c, add_special_tokens=False).tokens for c in choices])
+        indices = decode_choices(
+            model, [(static_prompt or []) + t for t in tokens], trie,
+            should_stop)
+        if None in indices and not return_partial:
+            raise DeadlineExceededException("Request was cancelled "
+                                            "during inference")
+        tracing.record_span("tokenization", start, tokenized,
+                            batch_size=len(tokens))
+        tracing.record_span("decode_choices", tokenized,
+                            time.perf_counter(), batch_size=len(tokens),
+                            choices=len(choices))
+        if details is not None:
+            details["finish_reasons"] = [
+                "cancelled" if i is None else "stop" for i in indices]
+            details["output_tokens"] = [0] * len(indices)
+            details["dropped_tokens"] = dropped_tokens
+            details["parameters"] = {
+                "max_input_tokens": max_input_tokens,
+                "choices": len(choices),
+            }
+            details["timings"] = {
+                "tokenization": tokenized - start,
+                "inference": time.perf_counter() - tokenized,
+            }
+        # Prompts cancelled before a choice was decoded complete to nothing
+        return ["" if i is None else choices[i] for i in indices]
 
     try:
-        results = model.translate_batch(
+        outputs_tokens = backends.generate_batch(
+            model,
             source=tokens,
             target_prefix=[prefix] * len(prompts),
+            max_decoding_length=max_decoding_length,
+            static_prompt=static_prompt,
+            cache_static_prompt=not context,
             repetition_penalty=repetition_penalty,
-            max_decoding_length=max_tokens,
             sampling_temperature=temperature,
             sampling_topk=topk,
             suppress_sequences=suppress,
             beam_size=1,
+            callback=callback,
         )
     except ValueError as e:
         raise InvalidTokenException(e)
-    outputs_tokens = [r.hypotheses[0] for r in results]
+    inferred = time.perf_counter()
+    if cancelled and not return_partial:
+        raise DeadlineExceededException("Request was cancelled "
+                                        "during inference")
+    if loops is not None:
+        for i, span in loops.loops.items():
+            # Only a single copy of the repeated span is returned
+            outputs_tokens[i] = prefix + trim_loop(
+                outputs_tokens[i][len(prefix):], span)
+            metrics.increment("repetition_loops_total")
+    finish_reasons = [
+        "cancelled" if i in cancelled
+        else "repetition" if loops is not None and i in loops.loops
+        else "length" if len(output) >= max_decoding_length
+        else "stop"
+        for i, output in enumerate(outputs_tokens)]
+    if length_key:
+        for output, reason in zip(outputs_tokens, finish_reasons):
+            if reason in ("cancelled", "repetition"):
+                continue
+            if reason == "length" and max_decoding_length < max_tokens:
+                metrics.increment("adaptive_cap_truncations_total",
+                                  key=length_key)
+            completion_lengths.observe(length_key, len(output) - len(prefix))
     for output in outputs_tokens:
         outputs_ids.append([tokenizer.token_to_id(t) for t in output])
-
-    return [tokenizer.decode(i, skip_special_tokens=True).lstrip()
-            for i in outputs_ids]
+    results = [tokenizer.decode(i, skip_special_tokens=True).lstrip()
+               for i in outputs_ids]
+    tracing.record_span("tokenization", start, tokenized,
+                        batch_size=len(tokens))
+    tracing.record_span("translate_batch", tokenized, inferred,
+                        batch_size=len(tokens),
+                        padded_tokens=len(tokens) * len_tokens,
+                        max_decoding_length=max_decoding_length,
+                        output_tokens=sum(map(len, outputs_tokens)))
+    tracing.record_span("detokenization", inferred, time.perf_counter(),
+                        batch_size=len(tokens))
+
+    if details is not None:
+        details["finish_reasons"] = finish_reasons
+        details["dropped_tokens"] = dropped_tokens
+        details["output_tokens"] = [len(o) - len(prefix)
+                                    for o in outputs_tokens]
+        details["parameters"] = {
+            "max_decoding_length": max_decoding_length,
+            "max_input_tokens": max_input_tokens,
+            "temperature": temperature,
+            "topk": topk,
+            "repetition_penalty": repetition_penalty,
+        }
+        details["timings"] = {
+            "tokenization": tokenized - start,
+            "inference": inferred - tokenized,
+            "detokenization": time.perf_counter() - inferred,
+        }
+    return results
 
 
 def list_tokens(prompt):
@@ -120,18 +429,21 @@ def list_tokens(prompt):
     ... # doctest: +ELLIPSIS
     [('...Hello', ...), ... ('...world', ...), ...]
     """
-    artifact_dir = get_artifact_dir()
-    model_info = get_model_info()
-    tokenizer, model = get_artifacts(artifact_dir, model_info)
+    tokenizer = load_tokenizer()
     output = tokenizer.encode(prompt, add_special_tokens=False)
     tokens = output.tokens
     ids = output.ids
     return list(zip(tokens, ids))
 
 
-def rank_instruct(inputs, targets):
+def rank_instruct(inputs, targets, k=None, normalize=False,
+                  preloaded_artifacts=None):
     """Sorts a list of targets by their probabilities
 
+    Returns the `k` most likely targets of each input (all of them by
+    default). If `normalize` is set, the probabilities are normalised by
+    the length of the targets.
+
     >>> rank_instruct(["Classify positive or negative: \
         I love python. Classification:"],
     ... ['positive', 'negative'])
@@ -144,31 +456,28 @@ def rank_instruct(inputs, targets):
 
     >>> rank_instruct(["Say six", "Say seven"], ["six", "seven"])
     [['six', 'seven'], ['seven', 'six']]
+
+    >>> rank_instruct(["Say six"], ["five", "six", "seven"], k=1)
+    [['six']]
     """
-    artifact_dir = get_artifact_dir()
-    model_info = get_model_info()
-    tokenizer, model = get_artifacts(artifact_dir, model_info)
-    targ_tok = [tokenizer.encode(t, add_special_tokens=False).tokens
-                for t in targets]
-    targ_tok *= len(inputs)
-
-    in_tok = []
-    for input in inputs:
-        toks = [tokenizer.encode(input, add_special_tokens=False).tokens]
-        in_tok += toks * len(targets)
-
-    if "Generator" in str(type(model)):
-        scores = model.score_batch([i+t for i, t in zip(in_tok, targ_tok)])
+    if not preloaded_artifacts:
+        artifact_dir = get_artifact_dir()
+        model_info = get_model_info()
+        tokenizer, model = get_artifacts(artifact_dir, model_info)
     else:
-        scores = model.score_batch(in_tok, target=targ_tok)
-
-    ret = []
-    for i in range(0, len(inputs) * len(targets), len(targets)):
-        logprobs = [sum(r.log_probs) for r in scores[i:i+len(targets)]]
-        results = sorted(zip(targets, logprobs), key=lambda r: -r[1])
-        ret.append([r[0] for r in results])
-
-    return ret
+        tokenizer, model = preloaded_artifacts
+
+    # Each input and target is tokenized once and the
+    # token lists are shared by all the pairs to score
+    in_tok = [e.tokens for e in tokenizer.encode_batch(
+        inputs, add_special_tokens=False)]
+    targ_tok = [e.tokens for e in tokenizer.encode_batch(
+        targets, add_special_tokens=False)]
+
+    scores = scoring.score_labels(model, in_tok, targ_tok,
+                                  normalize=normalize)
+    ranks = scoring.top_k(scores, k or len(targets))
+    return [[targets[j] for j in row] for row in ranks.tolist()]
 
 
 def parse_chat(prompt):
@@ -1,14 +1,23 @@
 import re
-import ctranslate2
 
+from contextlib import nullcontext
 from tokenizers import Tokenizer
+from telemetry import startup
+from languagemodels import replicas
+from languagemodels.backends import load_encoder, load_model
 from languagemodels.config import config, models
+from languagemodels.stub import StubTokenizer
 
 
 class ModelException(Exception):
     pass
 
 
+# Tokenizers and encoders already loaded by this process, by artifact path
+_tokenizers = {}
+_encoders = {}
+
+
 def get_model_info():
     """Gets info about the current model in use.
     """
@@ -19,12 +28,49 @@ def get_model_info():
     return m
 
 
+def get_tokenizer(artifact_dir):
+    """Loads the tokenizer from an artifact path, or returns
+    a stub tokenizer if there are no artifacts.
+
+    The tokenizer is parsed once per process and shared by
+    all later calls (e.g., token counts and reloads of the model).
+    """
+    if artifact_dir not in _tokenizers:
+        with startup.phase("tokenizer"):
+            if artifact_dir is None:
+                _tokenizers[artifact_dir] = StubTokenizer()
+            else:
+                _tokenizers[artifact_dir] = Tokenizer.from_file(
+                    f"{artifact_dir}/tokenizer.json")
+    return _tokenizers[artifact_dir]
+
+
+def get_encoder(artifact_dir, model_info):
+    """Loads the encoder for embeddings from an artifact path
+    the first time it is needed.
+    """
+    if artifact_dir not in _encoders:
+        with startup.phase("encoder"):
+            _encoders[artifact_dir] = load_encoder(artifact_dir, model_info)
+    return _encoders[artifact_dir]
+
+
 def get_artifacts(artifact_dir, model_info):
     """Loads tokenizer and model from an artifact path.
+
+    If "cpu_replicas" is set, that many replicas of the model are
+    loaded, each pinned to its own group of CPUs. Only the first load
+    is recorded as the startup phase, not later loads at runtime.
     """
-    compute_type = model_info["quantization"]
-    model = ctranslate2.Translator(artifact_dir, "cpu",
-                                   compute_type=compute_type)
-    tokenizer = Tokenizer.from_file(f"{artifact_dir}/tokenizer.json")
+    first_load = not startup.is_recorded("model")
+    with startup.phase("model") if first_load else nullcontext():
+        if config["cpu_replicas"]:
+            model = replicas.load_replicas(
+                lambda threads: load_model(artifact_dir, model_info,
+                                           intra_threads=threads),
+                replicas.get_cpu_groups(config["cpu_replicas"]))
+        else:
+            model = load_model(artifact_dir, model_info)
+    tokenizer = get_tokenizer(artifact_dir)
     cached_artifacts = (tokenizer, model)
     return cached_artifacts
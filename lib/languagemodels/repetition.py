@@ -0,0 +1,68 @@
+"""Detection of repetition loops during decoding
+
+A sequence is in a loop once its last tokens repeat a span of up to
+`max_span` tokens at least `min_repeats` times over at least
+`min_tokens` tokens (e.g., 12 times the same token or 3 times the same
+4 tokens). The check runs on every decoded token from the decoding
+callback, so that looping sequences are stopped as soon as the loop is
+detected instead of running until the maximum decoding length.
+
+>>> find_loop("a b c d e f".split())
+>>> find_loop("x y a b c a b c a b c a b".split(), min_tokens=6)
+(2, 3)
+>>> trim_loop("x y a b c a b c a b c a b".split(), 3)
+['x', 'y', 'a', 'b', 'c']
+"""
+
+MAX_SPAN = 16
+MIN_REPEATS = 3
+MIN_TOKENS = 12
+
+
+def find_loop(tokens, max_span=MAX_SPAN, min_repeats=MIN_REPEATS,
+              min_tokens=MIN_TOKENS):
+    """Returns the start of the repeated region at the end of tokens
+    and the length of the repeated span, or None if there is no loop"""
+    for span in range(1, max_span + 1):
+        length = max(span * min_repeats, min_tokens)
+        if length > len(tokens):
+            break
+        if tokens[-1] != tokens[-1 - span]:
+            continue
+        end = len(tokens)
+        if all(tokens[i] == tokens[i - span]
+               for i in range(end - length + span, end)):
+            start = end - length
+            while start > 0 and tokens[start - 1] == tokens[start - 1 + span]:
+                start -= 1
+            return start, span
+    return None
+
+
+def trim_loop(tokens, span):
+    """Keeps a single copy of the span repeated at the end of tokens"""
+    start = len(tokens) - span
+    while start > 0 and tokens[start - 1] == tokens[start - 1 + span]:
+        start -= 1
+    return tokens[:start + span]
+
+
+class LoopDetector:
+    """Tracks the tokens decoded for each sequence of a batch"""
+
+    def __init__(self, batch_size, **options):
+        self.options = options
+        self.tokens = [[] for _ in range(batch_size)]
+        # Length of the repeated span of each looping sequence
+        self.loops = {}
+
+    def update(self, batch_id, token):
+        """Appends a decoded token and returns True
+        once the sequence ends with a loop"""
+        tokens = self.tokens[batch_id]
+        tokens.append(token)
+        loop = find_loop(tokens, **self.options)
+        if loop is None:
+            return False
+        self.loops[batch_id] = loop[1]
+        return True
@@ -0,0 +1,133 @@
+"""Model replicas pinned to groups of CPUs
+
+The CPUs the process may run on are split into groups, following the
+NUMA nodes of the host when there are at least as many groups as nodes,
+and a replica of the model is loaded in each group. Each replica is
+loaded by a thread pinned to its group: the threads of the backend are
+created by it and inherit its affinity, and the weights are allocated
+on its NUMA node by the first-touch policy of the kernel. Calls go to
+the replica with the fewest calls in flight.
+
+>>> get_cpu_groups(2, cpus=range(8), nodes=[])
+[[0, 1, 2, 3], [4, 5, 6, 7]]
+>>> get_cpu_groups(4, cpus=range(8), nodes=[[0, 2, 4, 6], [1, 3, 5, 7]])
+[[0, 2], [4, 6], [1, 3], [5, 7]]
+>>> get_cpu_groups(3, cpus=[0, 1], nodes=[])
+[[0], [1]]
+"""
+
+import os
+import glob
+import threading
+
+from contextlib import contextmanager
+
+
+def _parse_cpu_list(cpu_list):
+    """Parses a sysfs CPU list such as "0-3,8-11" """
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if part:
+            first, _, last = part.partition("-")
+            cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def get_numa_nodes():
+    """Returns the CPUs of each NUMA node, or an empty
+    list if the topology is not exposed (e.g., not Linux)"""
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+        with open(path) as f:
+            nodes.append(_parse_cpu_list(f.read()))
+    return nodes
+
+
+def _split(cpus, count):
+    count = min(count, len(cpus))
+    return [cpus[i * len(cpus) // count:(i + 1) * len(cpus) // count]
+            for i in range(count)]
+
+
+def get_cpu_groups(count, cpus=None, nodes=None):
+    """Splits the CPUs available to the process into `count` groups
+
+    Groups do not span NUMA nodes if there are at least as many groups
+    as nodes, in which case they are spread evenly across the nodes.
+    There are never more groups than CPUs.
+    """
+    cpus = sorted(os.sched_getaffinity(0) if cpus is None else cpus)
+    if nodes is None:
+        nodes = get_numa_nodes()
+    nodes = [n for n in ([c for c in node if c in cpus] for node in nodes)
+             if n]
+    if len(nodes) < 2 or count < len(nodes):
+        return _split(cpus, count)
+    groups = []
+    for i, node in enumerate(nodes):
+        groups += _split(node, count // len(nodes) + (i < count % len(nodes)))
+    return groups
+
+
+@contextmanager
+def pinned(cpus):
+    """Pins the calling thread to a set of CPUs for the duration
+    of the block. Threads it starts keep that affinity."""
+    # On Linux, pid 0 sets the affinity of the calling thread only
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cpus)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+class ReplicaPool:
+    """Balances the calls to a model across its replicas
+
+    Methods are looked up on the replica with the fewest calls in
+    flight, so the pool can be used wherever a single model is.
+    """
+
+    def __init__(self, replicas):
+        self.replicas = replicas
+        self._in_flight = [0] * len(replicas)
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            index = self._in_flight.index(min(self._in_flight))
+            self._in_flight[index] += 1
+        return index
+
+    def _release(self, index):
+        with self._lock:
+            self._in_flight[index] -= 1
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name == "replicas":
+            raise AttributeError(name)
+        if not callable(getattr(self.replicas[0], name)):
+            return getattr(self.replicas[0], name)
+
+        def call(*args, **kwargs):
+            index = self._acquire()
+            try:
+                return getattr(self.replicas[index], name)(*args, **kwargs)
+            finally:
+                self._release(index)
+        return call
+
+
+def load_replicas(loader, groups, pin=True):
+    """Loads a replica in each CPU group using `loader`, which takes
+    the number of threads of the replica, and returns their pool.
+    Setting `pin` to False loads the same replicas unpinned."""
+    replicas = []
+    for cpus in groups:
+        if pin:
+            with pinned(cpus):
+                replicas.append(loader(len(cpus)))
+        else:
+            replicas.append(loader(len(cpus)))
+    return ReplicaPool(replicas)
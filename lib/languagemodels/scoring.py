@@ -0,0 +1,76 @@
+"""Scoring of label sets
+
+Each input and each label is tokenized once, and every (input, label)
+pair is scored by the model in sub-batches whose total number of tokens
+is capped, so that the memory of a batch is bounded regardless of the
+number of labels. The log probabilities are summed into an
+(inputs x labels) matrix from which the best labels are selected.
+
+>>> scores = np.array([[-1.0, -3.0, -2.0], [-5.0, -4.0, -0.5]])
+>>> top_k(scores, 2)
+array([[0, 2],
+       [2, 1]])
+"""
+
+import numpy as np
+
+from languagemodels import backends
+
+
+# Upper bound on the source and target tokens of a scoring batch
+MAX_BATCH_TOKENS = 16384
+
+
+def _iter_batches(pairs, lengths, max_batch_tokens):
+    batch, batch_tokens = [], 0
+    for pair, length in zip(pairs, lengths):
+        if batch and batch_tokens + length > max_batch_tokens:
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(pair)
+        batch_tokens += length
+    if batch:
+        yield batch
+
+
+def score_labels(model, inputs, labels, normalize=False,
+                 max_batch_tokens=MAX_BATCH_TOKENS):
+    """Returns the (inputs x labels) matrix of log probabilities of each
+    tokenized label given each tokenized input
+
+    If `normalize` is set, the log probabilities are divided by the
+    number of scored tokens so that longer labels are not penalised.
+    """
+    n_labels = len(labels)
+    pairs = [(i, j) for i in range(len(inputs)) for j in range(n_labels)]
+    lengths = [len(inputs[i]) + len(labels[j]) for i, j in pairs]
+    scores = np.empty(len(pairs))
+
+    start = 0
+    for batch in _iter_batches(pairs, lengths, max_batch_tokens):
+        log_probs = backends.score_batch(model,
+                                         [inputs[i] for i, _ in batch],
+                                         [labels[j] for _, j in batch])
+        counts = np.fromiter(map(len, log_probs), dtype=np.int64,
+                             count=len(batch))
+        flat = np.fromiter((p for row in log_probs for p in row),
+                           dtype=np.float64, count=counts.sum())
+        # Rows are summed with a single reduction over the flat array
+        sums = np.bincount(np.repeat(np.arange(len(batch)), counts),
+                           weights=flat, minlength=len(batch))
+        if normalize:
+            sums /= np.maximum(counts, 1)
+        scores[start:start + len(batch)] = sums
+        start += len(batch)
+
+    return scores.reshape(len(inputs), n_labels)
+
+
+def top_k(scores, k):
+    """Returns the column indices of the k highest scores
+    of each row, from the highest"""
+    k = min(k, scores.shape[1])
+    indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=1),
+                       axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1)
@@ -0,0 +1,236 @@
+"""Deterministic stub backend for hardware-free testing
+
+The stub implements the subset of the `tokenizers.Tokenizer`,
+`ctranslate2.Translator`, `ctranslate2.Generator` and
+`ctranslate2.Encoder` interfaces used
+by the package, so that the scheduling, batching and serialisation
+layers of the wrapper can be tested and load-tested without downloading
+a model.
+
+Outputs only depend on the inputs, and the latency of a batch is
+simulated as a fixed cost per decoding step that grows linearly with
+the batch size.
+
+>>> tokenizer = StubTokenizer()
+>>> encoding = tokenizer.encode("Hello, world!")
+>>> encoding.tokens
+['▁Hello', ',', '▁world', '!', '</s>']
+>>> tokenizer.decode(encoding.ids, skip_special_tokens=True)
+'Hello, world!'
+
+>>> translator = StubTranslator(token_latency=0)
+>>> result = translator.translate_batch([encoding.tokens],
+...                                     max_decoding_length=3)
+>>> result[0].hypotheses
+[['▁Hello', ',', '▁world']]
+"""
+
+import re
+import time
+import zlib
+import numpy as np
+
+from collections import namedtuple
+
+
+SPECIAL_TOKENS = {"<pad>": 0, "</s>": 1, "<unk>": 2}
+_TOKEN_PATTERN = re.compile(r"(\s*)(\w+|[^\w\s])")
+
+StubEncoding = namedtuple("StubEncoding", "tokens ids special_tokens_mask")
+StubTranslationResult = namedtuple("StubTranslationResult",
+                                   "hypotheses scores")
+StubGenerationResult = namedtuple("StubGenerationResult",
+                                  "sequences scores")
+StubScoringResult = namedtuple("StubScoringResult", "tokens log_probs")
+StubEncoderOutput = namedtuple("StubEncoderOutput",
+                               "last_hidden_state pooler_output")
+StubGenerationStepResult = namedtuple(
+    "StubGenerationStepResult",
+    "step batch_id token_id hypothesis_id token log_prob is_last")
+
+
+def _stable_hash(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+class StubTokenizer:
+    """Word-level tokenizer with SentencePiece-like tokens
+    and ids derived from a stable hash of each token"""
+
+    def __init__(self, vocab_size=32000):
+        self.vocab_size = vocab_size
+        self._id_to_token = {i: t for t, i in SPECIAL_TOKENS.items()}
+
+    def get_vocab_size(self):
+        return self.vocab_size
+
+    def token_to_id(self, token):
+        if token in SPECIAL_TOKENS:
+            return SPECIAL_TOKENS[token]
+        token_id = len(SPECIAL_TOKENS) + _stable_hash(token) % (
+            self.vocab_size - len(SPECIAL_TOKENS))
+        self._id_to_token.setdefault(token_id, token)
+        return token_id
+
+    def id_to_token(self, token_id):
+        return self._id_to_token.get(token_id)
+
+    def encode(self, text, add_special_tokens=True):
+        tokens = [("▁" if space or i == 0 else "") + piece
+                  for i, (space, piece)
+                  in enumerate(_TOKEN_PATTERN.findall(text))]
+        mask = [0] * len(tokens)
+        if add_special_tokens:
+            tokens.append("</s>")
+            mask.append(1)
+        return StubEncoding(tokens, [self.token_to_id(t) for t in tokens],
+                            mask)
+
+    def encode_batch(self, texts, add_special_tokens=True):
+        return [self.encode(t, add_special_tokens) for t in texts]
+
+    def decode(self, ids, skip_special_tokens=True):
+        special_ids = set(SPECIAL_TOKENS.values())
+        tokens = [self.id_to_token(i) or "<unk>" for i in ids
+                  if not (skip_special_tokens and i in special_ids)]
+        return "".join(tokens).replace("▁", " ").lstrip()
+
+
+class StubTranslator:
+    """Fake Translator whose outputs echo the source tokens
+
+    The completion of each example cycles through its source tokens
+    (excluding special tokens) for a length derived from a stable hash
+    of the source. Every decoding step sleeps for `token_latency`
+    seconds scaled by `1 + batch_scaling * (batch_size - 1)`, and the
+    encoder sleeps for `input_token_latency` per source token.
+    """
+
+    def __init__(self, token_latency=0.005, input_token_latency=0.0001,
+                 batch_scaling=0.1, min_output_tokens=4,
+                 max_output_tokens=32):
+        self.token_latency = token_latency
+        self.input_token_latency = input_token_latency
+        self.batch_scaling = batch_scaling
+        self.min_output_tokens = min_output_tokens
+        self.max_output_tokens = max_output_tokens
+
+    def _output_tokens(self, source):
+        content = [t for t in source if t not in SPECIAL_TOKENS] or ["▁"]
+        length = self.min_output_tokens + _stable_hash(" ".join(source)) \
+            % (self.max_output_tokens - self.min_output_tokens + 1)
+        return [content[i % len(content)] for i in range(length)]
+
+    def _continue(self, source, prefix):
+        # Prefixes of the output are continued consistently
+        # whilst other prefixes are followed by the full output
+        output = self._output_tokens(source)
+        if output[:len(prefix)] == prefix:
+            return output
+        return prefix + output
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def translate_batch(self, source, target_prefix=None,
+                        max_decoding_length=256, callback=None, **kwargs):
+        batch_size = len(source)
+        target_prefix = target_prefix or [[] for _ in source]
+        step_latency = self.token_latency * (
+            1 + self.batch_scaling * (batch_size - 1))
+        self._sleep(self.input_token_latency * batch_size
+                    * max(len(s) for s in source))
+
+        # Like CTranslate2, the target prefix is decoded (and
+        # reported to the callback) step by step
+        outputs = [[] for _ in source]
+        pending = [self._continue(s, p or [])
+                   for s, p in zip(source, target_prefix)]
+        active = set(range(batch_size))
+        step = 0
+        while active:
+            self._sleep(step_latency)
+            for i in sorted(active):
+                output = outputs[i]
+                if len(output) >= min(len(pending[i]), max_decoding_length):
+                    active.discard(i)
+                    continue
+                token = pending[i][len(output)]
+                output.append(token)
+                is_last = len(output) >= min(len(pending[i]),
+                                             max_decoding_length)
+                if callback is not None and callback(
+                        StubGenerationStepResult(
+                            step, i, _stable_hash(token), 0, token,
+                            -0.1, is_last)):
+                    active.discard(i)
+            step += 1
+
+        return [StubTranslationResult([o], [-0.1 * len(o)])
+                for o in outputs]
+
+    def score_batch(self, source, target, **kwargs):
+        self._sleep(self.token_latency * len(source) * (
+            1 + self.batch_scaling * (len(source) - 1)))
+        results = []
+        for s, t in zip(source, target):
+            # Tokens of the output of translate_batch are likely
+            # whilst other tokens get a pseudo-random log probability
+            expected = self._output_tokens(s) + ["</s>"]
+            key = " ".join(s)
+            log_probs = [-0.05 if j < len(expected) and expected[j] == tok
+                         else -1 - (_stable_hash(key + tok) % 900) / 100
+                         for j, tok in enumerate(t + ["</s>"])]
+            results.append(StubScoringResult(t + ["</s>"], log_probs))
+        return results
+
+
+class StubGenerator(StubTranslator):
+    """Fake Generator with the same outputs and latency
+    model as StubTranslator, where the source is the prompt"""
+
+    def generate_batch(self, start_tokens, max_length=512,
+                       static_prompt=None, include_prompt_in_result=True,
+                       callback=None, **kwargs):
+        source = [(static_prompt or []) + t for t in start_tokens]
+        results = self.translate_batch(source, max_decoding_length=max_length,
+                                       callback=callback)
+        return [StubGenerationResult(
+            [(t if include_prompt_in_result else []) + r.hypotheses[0]],
+            r.scores) for t, r in zip(start_tokens, results)]
+
+    def score_batch(self, tokens, **kwargs):
+        self._sleep(self.token_latency * len(tokens) * (
+            1 + self.batch_scaling * (len(tokens) - 1)))
+        return [StubScoringResult(t[1:], [
+            -(_stable_hash(" ".join(t[:i]) + t[i]) % 1000) / 100
+            for i in range(1, len(t))]) for t in tokens]
+
+
+class StubEncoder:
+    """Fake Encoder whose hidden states are pseudo-random vectors
+    seeded by each token, padded to the longest sequence"""
+
+    def __init__(self, hidden_size=64, token_latency=0.0001):
+        self.hidden_size = hidden_size
+        self.token_latency = token_latency
+        self._vectors = {}
+
+    def _vector(self, token):
+        if token not in self._vectors:
+            rng = np.random.default_rng(_stable_hash(token))
+            self._vectors[token] = rng.standard_normal(
+                self.hidden_size, dtype=np.float32)
+        return self._vectors[token]
+
+    def forward_batch(self, inputs, **kwargs):
+        max_length = max(len(t) for t in inputs)
+        if self.token_latency > 0:
+            time.sleep(self.token_latency * len(inputs) * max_length)
+        hidden = np.zeros((len(inputs), max_length, self.hidden_size),
+                          dtype=np.float32)
+        for i, tokens in enumerate(inputs):
+            for j, token in enumerate(tokens):
+                hidden[i, j] = self._vector(token)
+        return StubEncoderOutput(hidden, None)
@@ -0,0 +1,7 @@
+"""Metrics, startup timings and tracing
+
+These modules only depend on the standard library (and, once tracing is
+configured, on the OpenTelemetry SDK), so that processes that do not
+load the model, such as the router, can import them without the
+bootstrap configuration that `languagemodels` loads on import.
+"""
@@ -0,0 +1,70 @@
+"""In-process metrics registry
+
+Counters and gauges are stored in plain dictionaries keyed by metric
+name and labels. The wrapper exposes them in the Prometheus text format
+so that both the library and the API layer can report through a single
+metrics surface.
+
+>>> reset()
+>>> increment("requests_total", endpoint="completions")
+>>> increment("requests_total", 2, endpoint="completions")
+>>> set_gauge("cache_bytes", 128)
+>>> get_value("requests_total", endpoint="completions")
+3
+>>> print(render())
+cache_bytes 128
+requests_total{endpoint="completions"} 3
+"""
+
+import threading
+
+_counters = {}
+_gauges = {}
+_lock = threading.Lock()
+
+
+def _make_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Adds value to a counter"""
+    key = _make_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Sets a gauge to an absolute value"""
+    _gauges[_make_key(name, labels)] = value
+
+
+def get_value(name, **labels):
+    """Returns the current value of a counter or gauge"""
+    key = _make_key(name, labels)
+    if key in _counters:
+        return _counters[key]
+    return _gauges.get(key, 0)
+
+
+def reset():
+    """Clears all the recorded metrics"""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in labels)
+    return "{" + pairs + "}"
+
+
+def render():
+    """Renders all metrics in the Prometheus text format"""
+    with _lock:
+        items = list(_counters.items()) + list(_gauges.items())
+    lines = [f"{name}{_format_labels(labels)} {value}"
+             for (name, labels), value in sorted(items)]
+    return "\n".join(lines)
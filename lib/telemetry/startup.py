@@ -0,0 +1,71 @@
+"""Startup profiling
+
+The durations of the startup phases (imports, configuration, tokenizer
+and model loading, warm-up and the first request) are recorded from the
+first import of this module, so that cold starts can be broken down.
+Each phase is exported as the gauge `startup_phase_seconds`.
+
+>>> reset()
+>>> record("model", 1.5)
+>>> with phase("tokenizer"):
+...     pass
+>>> list(get_timings())
+['model', 'tokenizer']
+>>> get_exceeded_phases({"model": 1.0, "tokenizer": 1.0})
+['model']
+"""
+
+import time
+
+from contextlib import contextmanager
+from telemetry import metrics
+
+_started = time.perf_counter()
+_timings = {}
+
+
+def record(name, seconds):
+    """Adds seconds to the duration of a phase"""
+    _timings[name] = _timings.get(name, 0) + seconds
+    metrics.set_gauge("startup_phase_seconds", _timings[name], phase=name)
+
+
+@contextmanager
+def phase(name):
+    """Records the duration of the enclosed block as a phase"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def record_elapsed(name):
+    """Records the time since the start of the package import that
+    is not accounted for by other phases (e.g., module imports)"""
+    elapsed = time.perf_counter() - _started
+    record(name, max(elapsed - sum(_timings.values()), 0))
+
+
+def is_recorded(name):
+    return name in _timings
+
+
+def get_timings():
+    """Returns the duration of each recorded phase in seconds"""
+    return dict(_timings)
+
+
+def get_exceeded_phases(budgets):
+    """Returns the phases whose duration is over their budget"""
+    return [name for name, seconds in _timings.items()
+            if name in budgets and seconds > budgets[name]]
+
+
+def format_timings():
+    return " ".join(f"{name}={seconds:.3f}s"
+                    for name, seconds in _timings.items())
+
+
+def reset():
+    _timings.clear()
@@ -0,0 +1,110 @@
+"""OpenTelemetry tracing of inference
+
+Tracing is off until `configure` is called, in which case `span` and
+`record_span` return immediately, so that the stages of inference can
+be traced without any overhead for deployments that do not use it. The
+OpenTelemetry SDK is only imported once tracing is configured.
+
+Most stages are already timed with `time.perf_counter` (e.g., for the
+request profile), so they are recorded after the fact from those
+timestamps with `record_span` rather than wrapped in context managers.
+Spans are children of the current span, which follows the request
+across the thread pool through the context variables.
+
+>>> with span("tokenization") as s:
+...     s is None
+True
+"""
+
+import time
+
+from contextlib import nullcontext
+
+
+class TracingException(Exception):
+    pass
+
+
+EXPORTERS = ["console", "file", "otlp"]
+
+_tracer = None
+_provider = None
+
+
+def _get_exporter(exporter, path=None, endpoint=None):
+    if exporter == "console":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        return ConsoleSpanExporter()
+    if exporter == "file":
+        from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+        # One span per line so that the file can be read as JSONL
+        return ConsoleSpanExporter(
+            out=open(path, "a"),
+            formatter=lambda s: s.to_json(indent=None) + "\n")
+    if exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter \
+            import OTLPSpanExporter
+        return OTLPSpanExporter(endpoint=endpoint)
+    raise TracingException(f"Unknown span exporter: {exporter}")
+
+
+def configure(exporter="console", path="spans.jsonl", endpoint=None,
+              sample_rate=1.0, service_name="ctranslate2-fastapi"):
+    """Enables tracing with an exporter among EXPORTERS
+
+    The "file" exporter appends spans to `path` as JSON lines, which
+    works offline, and "otlp" sends them to an OTLP/HTTP `endpoint`
+    (by default the one set by the OTEL_EXPORTER_OTLP_* variables).
+    A `sample_rate` share of the traces is kept.
+    """
+    global _tracer, _provider
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.sampling import ParentBased
+        from opentelemetry.sdk.trace.sampling import TraceIdRatioBased
+    except ImportError:
+        raise TracingException("Tracing requires the opentelemetry-sdk "
+                               "package to be installed")
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": service_name}),
+        sampler=ParentBased(TraceIdRatioBased(sample_rate)))
+    _provider.add_span_processor(BatchSpanProcessor(
+        _get_exporter(exporter, path, endpoint)))
+    _tracer = _provider.get_tracer(__name__)
+
+
+def shutdown():
+    """Exports the pending spans and disables tracing"""
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer, _provider = None, None
+
+
+def is_enabled():
+    return _tracer is not None
+
+
+# Reusable context manager of the spans traced whilst tracing is off
+_NO_SPAN = nullcontext()
+
+
+def span(name, **attributes):
+    """Returns a context manager that traces a block as a span
+    of the current trace, and yields the span (None if off)"""
+    if _tracer is None:
+        return _NO_SPAN
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+def record_span(name, start, end, **attributes):
+    """Records a stage that ran between two `time.perf_counter`
+    timestamps as a span of the current trace"""
+    if _tracer is None:
+        return
+    offset = time.time_ns() - int(time.perf_counter() * 1e9)
+    s = _tracer.start_span(name, attributes=attributes,
+                           start_time=offset + int(start * 1e9))
+    s.end(end_time=offset + int(end * 1e9))
@@ -0,0 +1,141 @@
+import sys
+import random
+
+from collections import namedtuple
+from collections import OrderedDict
+from telemetry import metrics
+
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+Fingerprint = namedtuple("Fingerprint", "namespace ids signature")
+
+
+class SemanticCache:
+    """Second-tier response cache that serves completions
+    for prompts that are near-duplicates of a cached one.
+
+    Prompts are canonicalised (casing and whitespace are
+    discarded, but not punctuation, which can change the
+    meaning of a prompt, e.g., "2+2" and "2*2") and encoded into token ids
+    using the loaded tokenizer. Token id shingles are then
+    fingerprinted with MinHash and candidates are looked up
+    through locality-sensitive hashing on signature bands.
+    A cached completion is served only when the estimated
+    Jaccard similarity reaches the configured threshold.
+
+    Entries are evicted in LRU order once the estimated
+    memory footprint exceeds max_bytes."""
+
+    def __init__(self, tokenizer, threshold=0.9, max_bytes=16 * 2 ** 20,
+                 num_perm=64, bands=16, shingle_size=2):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.tokenizer = tokenizer
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = random.Random(0)
+        self._perms = [(rng.randrange(1, _MERSENNE_PRIME),
+                        rng.randrange(0, _MERSENNE_PRIME))
+                       for _ in range(num_perm)]
+        self._entries = OrderedDict()
+        self._buckets = dict()
+        self.size_bytes = 0
+
+    def canonicalise(self, prompt):
+        """Returns the token ids of the canonical form of a prompt."""
+        text = " ".join(prompt.lower().split())
+        return tuple(self.tokenizer.encode(
+            text, add_special_tokens=False).ids)
+
+    def _shingles(self, ids):
+        n = self.shingle_size
+        if len(ids) <= n:
+            return {hash(ids)}
+        return {hash(ids[i:i + n]) for i in range(len(ids) - n + 1)}
+
+    def _minhash(self, ids):
+        shingles = [s & _MAX_HASH for s in self._shingles(ids)]
+        return tuple(
+            min((a * s + b) % _MERSENNE_PRIME for s in shingles)
+            for a, b in self._perms)
+
+    def fingerprint(self, namespace, prompt):
+        ids = self.canonicalise(prompt)
+        return Fingerprint(namespace, ids, self._minhash(ids))
+
+    def _band_keys(self, fp):
+        r = self.rows
+        return [(fp.namespace, i, fp.signature[i * r:(i + 1) * r])
+                for i in range(self.bands)]
+
+    @staticmethod
+    def similarity(sig1, sig2):
+        """Estimates the Jaccard similarity of two signatures."""
+        return sum(a == b for a, b in zip(sig1, sig2)) / len(sig1)
+
+    def get(self, fp, details=None):
+        """Returns the cached completion most similar to the
+        fingerprint or None if nothing is above threshold.
+        If a details dict is provided, it is updated with the
+        details stored along with the completion."""
+        key = (fp.namespace, fp.ids)
+        if key in self._entries:
+            best_key = key
+        else:
+            candidates = set()
+            for band_key in self._band_keys(fp):
+                candidates |= self._buckets.get(band_key, set())
+            best_key, best_score = None, self.threshold
+            for candidate in candidates:
+                score = self.similarity(
+                    fp.signature, self._entries[candidate][0].signature)
+                if score >= best_score:
+                    best_key, best_score = candidate, score
+        if best_key is None:
+            metrics.increment("semantic_cache_misses_total")
+            return None
+        self._entries.move_to_end(best_key)
+        metrics.increment("semantic_cache_hits_total")
+        _, completion, stored_details, _ = self._entries[best_key]
+        if details is not None:
+            details.update(stored_details)
+        return completion
+
+    def _entry_size(self, fp, completion, details):
+        return (sys.getsizeof(completion) + sys.getsizeof(details)
+                + 8 * (len(fp.ids) + len(fp.signature))
+                + 64 * self.bands)
+
+    def put(self, fp, completion, details=None):
+        """Stores a completion, and optionally a small dict of
+        its details (e.g., its finish reasons) returned on hits"""
+        key = (fp.namespace, fp.ids)
+        if key in self._entries:
+            self._evict(key)
+        details = dict(details or {})
+        size = self._entry_size(fp, completion, details)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (fp, completion, details, size)
+        for band_key in self._band_keys(fp):
+            self._buckets.setdefault(band_key, set()).add(key)
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+            metrics.increment("semantic_cache_evictions_total")
+        metrics.set_gauge("semantic_cache_bytes", self.size_bytes)
+        metrics.set_gauge("semantic_cache_entries", len(self._entries))
+
+    def _evict(self, key):
+        fp, _, _, size = self._entries.pop(key)
+        for band_key in self._band_keys(fp):
+            bucket = self._buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[band_key]
+        self.size_bytes -= size
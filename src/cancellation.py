@@ -0,0 +1,96 @@
+import time
+import asyncio
+
+from fastapi.concurrency import run_in_threadpool
+from telemetry import tracing
+from languagemodels.inference import DeadlineExceededException
+
+
+DISCONNECT_POLL_INTERVAL = 0.1
+
+
+def min_timeout(*timeouts):
+    """Returns the smallest of the timeouts
+    that were set, or None if none was set."""
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+
+class RequestCancellation:
+    """Tracks the deadline and the client
+    connection of an in-flight request."""
+
+    def __init__(self, timeout=None):
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.monotonic() + timeout
+        self.disconnected = False
+
+    def is_expired(self):
+        return self.deadline is not None \
+            and time.monotonic() >= self.deadline
+
+    def should_stop(self):
+        return self.disconnected or self.is_expired()
+
+
+async def _watch_disconnect(request, cancellation):
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+    cancellation.disconnected = True
+
+
+async def wait_cancellable(request, cancellation, awaitable):
+    """Awaits a wait that does not run inference (e.g., for the
+    result of another request) until the client disconnects or the
+    deadline expires, in which case the wait is cancelled and a
+    DeadlineExceededException raised."""
+    if cancellation.should_stop():
+        raise DeadlineExceededException("Request deadline expired "
+                                        "before waiting")
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.create_task(
+        _watch_disconnect(request, cancellation))
+    timeout = None
+    if cancellation.deadline is not None:
+        timeout = max(cancellation.deadline - time.monotonic(), 0)
+    try:
+        done, _ = await asyncio.wait([task, watcher], timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if task in done:
+            return task.result()
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+    # Lets the wait clean up (e.g., leave a queue) before raising
+    await asyncio.wait([task])
+    raise DeadlineExceededException("Request was cancelled whilst waiting")
+
+
+def _run_queued(profile, scheduled, func, *args, **kwargs):
+    now = time.perf_counter()
+    profile.record("queueing", now - scheduled)
+    tracing.record_span("queueing", scheduled, now)
+    return func(*args, **kwargs)
+
+
+async def run_cancellable(request, cancellation, func, *args,
+                          profile=None, **kwargs):
+    """Runs a blocking inference function in the threadpool
+    whilst watching the client connection. Requests whose
+    deadline expired are dropped before being scheduled.
+    The time spent waiting for a worker thread is recorded
+    in the optional request profile."""
+    if cancellation.should_stop():
+        raise DeadlineExceededException("Request deadline expired "
+                                        "before inference was scheduled")
+    if profile is not None:
+        func, args = _run_queued, (profile, time.perf_counter(), func, *args)
+    watcher = asyncio.create_task(
+        _watch_disconnect(request, cancellation))
+    try:
+        return await run_in_threadpool(
+            func, *args, should_stop=cancellation.should_stop, **kwargs)
+    finally:
+        watcher.cancel()
@@ -0,0 +1,51 @@
+import asyncio
+
+from telemetry import metrics
+
+
+class SingleFlight:
+    """Coalesces identical in-flight requests so that duplicates
+    arriving whilst the first one runs await its result instead
+    of running their own inference.
+
+    Only deterministic requests (e.g., greedy decoding) should be
+    coalesced, since all of them get the same completion."""
+
+    def __init__(self):
+        self._in_flight = dict()
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    async def run(self, key, infer, details, wait=None):
+        """Runs infer unless a call with the same key is in flight,
+        in which case its completion and details are shared.
+        Duplicates of a call that failed or was cancelled run
+        their own inference.
+
+        Duplicates await the first call through `wait` if set, which
+        bounds the wait (e.g., by their own deadline) and raises
+        when it is exceeded. The first call keeps running."""
+        leader = self._in_flight.get(key)
+        if leader is not None:
+            shielded = asyncio.shield(leader)
+            completion, leader_details = await (
+                wait(shielded) if wait is not None else shielded)
+            if leader_details is not None and "cancelled" \
+                    not in leader_details.get("finish_reasons", []):
+                metrics.increment("coalesced_requests_total")
+                details.update(leader_details)
+                return completion
+            metrics.increment("coalesced_fallbacks_total")
+            return await infer()
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            completion = await infer()
+            future.set_result((completion, details))
+            return completion
+        finally:
+            if not future.done():
+                future.set_result((None, None))
+            del self._in_flight[key]
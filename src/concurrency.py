@@ -0,0 +1,75 @@
+import math
+import threading
+
+from telemetry import metrics
+
+
+class OverloadedException(Exception):
+    pass
+
+
+class AdaptiveConcurrencyLimiter:
+    """Gradient-based limit on the number of in-flight inference calls
+
+    After each call, the ratio between the baseline latency and the
+    observed one (the gradient, clamped to [0.5, 1]) scales the limit
+    down when latency grows because of contention, whilst a headroom of
+    sqrt(limit) lets it grow when latency stays within `tolerance` times
+    the baseline. The baseline is `target_latency` if set, otherwise the
+    lowest latency observed. Latencies are measured per decoded token
+    so that they do not depend on the length of the completions. Calls
+    over the limit are shed immediately.
+
+    The limit starts low so that the baseline is observed without
+    contention, and grows from there (i.e., a slow start).
+    """
+
+    def __init__(self, initial_limit=1, min_limit=1, max_limit=64,
+                 target_latency=None, tolerance=1.5, smoothing=0.2):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.min_latency = None
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        metrics.set_gauge("concurrency_limit", int(self.limit))
+
+    def acquire(self):
+        """Takes a slot or raises an OverloadedException"""
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                metrics.increment("shed_requests_total")
+                raise OverloadedException(
+                    f"Server is at its concurrency limit of "
+                    f"{int(self.limit)} requests")
+            self.in_flight += 1
+            metrics.set_gauge("concurrency_in_flight", self.in_flight)
+
+    def release(self, latency=None):
+        """Frees a slot and updates the limit from the latency per
+        token of the call, if it completed normally"""
+        with self._lock:
+            self.in_flight -= 1
+            metrics.set_gauge("concurrency_in_flight", self.in_flight)
+            if latency is not None:
+                self._update(latency)
+
+    def _get_baseline(self, latency):
+        if self.target_latency:
+            return self.target_latency
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        return self.min_latency
+
+    def _update(self, latency):
+        baseline = self._get_baseline(latency)
+        gradient = min(max(self.tolerance * baseline / max(latency, 1e-9),
+                           0.5), 1.0)
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        limit = (1 - self.smoothing) * self.limit \
+            + self.smoothing * new_limit
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        metrics.set_gauge("concurrency_limit", int(self.limit))
@@ -2,9 +2,11 @@ import os
 import yaml
 import logging
 
+from telemetry import startup
+
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
-with open(f"{current_dir}/config.yaml", "r") as f:
+with startup.phase("config"), open(f"{current_dir}/config.yaml", "r") as f:
     config = yaml.load(f, Loader=yaml.BaseLoader)
 
 
@@ -15,6 +17,137 @@ def get_app_title():
 def get_app_description():
     return config["description"]
 
+
+def _to_bool(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def get_semantic_cache_config():
+    """Returns the settings of the near-duplicate
+    response cache converted to their types."""
+    c = config["semantic_cache"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "threshold": float(c["threshold"]),
+        "max_bytes": int(c["max_bytes"]),
+        "num_perm": int(c["num_perm"]),
+        "bands": int(c["bands"]),
+    }
+
+
+def get_rate_limit_config():
+    """Returns the settings of the per API key token
+    buckets converted to their types."""
+    c = config["rate_limit"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "tokens_per_second": float(c["tokens_per_second"]),
+        "burst_tokens": float(c["burst_tokens"]),
+        "sqlite_path": c["sqlite_path"] or None,
+        "limits": {k: (float(v["tokens_per_second"]),
+                       float(v["burst_tokens"]))
+                   for k, v in c["keys"].items()},
+    }
+
+
+def get_concurrency_config():
+    """Returns the settings of the adaptive
+    concurrency limit converted to their types."""
+    c = config["concurrency"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "max_limit": int(c["max_limit"]),
+        "target_latency": float(c["target_latency"])
+        if c["target_latency"] else None,
+        "tolerance": float(c["tolerance"]),
+    }
+
+
+def get_scheduling_config():
+    """Returns the settings of the inference
+    scheduler converted to their types."""
+    c = config["scheduling"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "policy": c["policy"],
+        "slots": int(c["slots"]),
+        "aging": float(c["aging"]),
+    }
+
+
+def get_single_flight_config():
+    """Returns the settings of the coalescing
+    of identical in-flight requests."""
+    c = config["single_flight"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+    }
+
+
+def get_profiling_config():
+    """Returns the settings of the slow request
+    log and /debug endpoints converted to their types."""
+    c = config["profiling"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "capacity": int(c["slow_requests"]),
+        "sample_rate": float(c["sample_rate"]),
+    }
+
+
+def get_recording_config():
+    """Returns the settings of the traffic
+    recorder converted to their types."""
+    c = config["recording"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "path": c["path"],
+        "sample_rate": float(c["sample_rate"]),
+        "redact": list(c["redact"]),
+    }
+
+
+def get_tracing_config():
+    """Returns the settings of the
+    span exporter converted to their types."""
+    c = config["tracing"]
+    return {
+        "enabled": _to_bool(c["enabled"]),
+        "exporter": c["exporter"],
+        "path": c["path"],
+        "endpoint": c["endpoint"] or None,
+        "sample_rate": float(c["sample_rate"]),
+    }
+
+
+def get_router_config():
+    """Returns the settings of the router
+    mode converted to their types."""
+    c = config["router"]
+    backends = os.environ.get("ROUTER_BACKENDS")
+    return {
+        "backends": backends.split(",") if backends else c["backends"],
+        "prefix_chars": int(c["prefix_chars"]),
+        "virtual_nodes": int(c["virtual_nodes"]),
+        "load_factor": float(c["load_factor"]),
+        "health_interval": float(c["health_interval"]),
+        "ejection_seconds": float(c["ejection_seconds"]),
+        "max_connections": int(c["max_connections"]),
+        "timeout": float(c["timeout"]),
+    }
+
+
+def get_startup_config():
+    """Returns whether to warm up the model at startup
+    and the time budget of each startup phase in seconds."""
+    c = config["startup"]
+    return {
+        "warmup": _to_bool(c["warmup"]),
+        "budget_seconds": {k: float(v)
+                           for k, v in c["budget_seconds"].items()},
+    }
+
+
 def get_logger(name):
     """
     Creates a logger where level is
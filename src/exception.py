@@ -5,6 +5,10 @@ from functools import wraps
 from languagemodels.inference import InvalidTokenException
 from languagemodels.inference import InferenceException
 from languagemodels.inference import MaxTokensException
+from languagemodels.inference import DeadlineExceededException
+from concurrency import OverloadedException
+from ratelimit import RateLimitExceededException
+from ratelimit import get_retry_after_header
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +31,24 @@ def error_handling(func):
             logger.error(e)
             raise HTTPException(status_code=413,
                                 detail=_format_exception(e))
+        except RateLimitExceededException as e:
+            logger.warning(e)
+            headers = None
+            if e.retry_after is not None:
+                headers = {"Retry-After":
+                           get_retry_after_header(e.retry_after)}
+            raise HTTPException(status_code=429,
+                                detail=_format_exception(e),
+                                headers=headers)
+        except OverloadedException as e:
+            logger.warning(e)
+            raise HTTPException(status_code=503,
+                                detail=_format_exception(e),
+                                headers={"Retry-After": "1"})
+        except DeadlineExceededException as e:
+            logger.warning(e)
+            raise HTTPException(status_code=504,
+                                detail=_format_exception(e))
         except Exception as e:
             logger.error(e)
             raise HTTPException(status_code=500,
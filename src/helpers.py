@@ -1,7 +1,11 @@
-import random
-import string
+import uuid
+import base64
+import itertools
+import numpy as np
 import languagemodels as lm
 
+from languagemodels.embeddings import quantize
+
 
 PRIMITIVES = (bool, str, int, float, type(None))
 
@@ -28,30 +32,72 @@ def serialize_messages(messages):
     return messages_serial
 
 
-def _generate_random_id(N=10):
-    """Generates a random alphanumeric
-    string of N characters."""
-    return ''.join(
-        random.choices(
-            string.ascii_uppercase + string.digits, k=N))
+# Unique per process, so that ids from different
+# workers do not collide
+_ID_PREFIX = uuid.uuid4().hex[:4].upper()
+_id_counter = itertools.count()
+
 
+def _generate_id():
+    """Generates a unique alphanumeric id from a
+    per-process prefix and a monotonic counter."""
+    return f"{_ID_PREFIX}{next(_id_counter):06X}"
 
-def _calculate_tokens(prompt, completion):
-    return lm.count_tokens(prompt), lm.count_tokens(completion)
 
+def _calculate_tokens(tokenizer, prompt, completion):
+    """Counts the tokens of prompt and completion
+    in a single call to the preloaded tokenizer."""
+    encodings = tokenizer.encode_batch(
+        [prompt, completion], add_special_tokens=False)
+    return len(encodings[0].ids), len(encodings[1].ids)
 
-def prefill_response(prompt, completion):
+
+def prefill_response(prompt, completion, tokenizer, dropped_tokens=0):
     """Boilerplate for generating a response
     with the same schema of that from OpenAI."""
     prompt_tks, completion_tks = \
-        _calculate_tokens(prompt, completion)
+        _calculate_tokens(tokenizer, prompt, completion)
     return {
-        "id": _generate_random_id(),
+        "id": _generate_id(),
         "model": lm.get_model_name(),
         "usage": {
             "completion_tokens": completion_tks,
             "prompt_tokens": prompt_tks,
-            "total_tokens": completion_tks + prompt_tks
+            "total_tokens": completion_tks + prompt_tks,
+            "dropped_prompt_tokens": dropped_tokens
+        }
+    }
+
+
+def make_embeddings_response(vectors, tokens, encoding_format,
+                             precision):
+    """Builds a response with the same schema of the embeddings API
+    of OpenAI. Embeddings are cast to `precision` and, for the base64
+    format, encoded from their raw little-endian bytes. int8 embeddings
+    come with the scale that converts them back to floats."""
+    vectors, scales = quantize(vectors, precision)
+    if encoding_format == "base64":
+        vectors = vectors.astype(vectors.dtype.newbyteorder("<"))
+    elif precision == "float16":
+        # float16 arrays are not serialisable as JSON
+        vectors = vectors.astype(np.float32)
+    data = []
+    for i, vector in enumerate(vectors):
+        item = {"object": "embedding", "index": i}
+        if encoding_format == "base64":
+            item["embedding"] = base64.b64encode(vector.tobytes()).decode()
+        else:
+            item["embedding"] = vector
+        if scales is not None:
+            item["scale"] = float(scales[i])
+        data.append(item)
+    return {
+        "object": "list",
+        "data": data,
+        "model": lm.get_model_name(),
+        "usage": {
+            "prompt_tokens": sum(tokens),
+            "total_tokens": sum(tokens)
         }
     }
 
@@ -69,6 +115,25 @@ def clean_completion(completion):
     return completion
 
 
+def get_api_key(authorization, x_api_key):
+    """Returns the API key of a request from the X-API-Key
+    header or a bearer Authorization header, if any."""
+    if x_api_key:
+        return x_api_key
+    if authorization and authorization.lower().startswith("bearer "):
+        return authorization[len("bearer "):].strip()
+    return "anonymous"
+
+
+def is_cache_bypassed(cache_control):
+    """Checks whether the Cache-Control header
+    of a request opts out of response caching."""
+    if not cache_control:
+        return False
+    directives = {d.strip().lower() for d in cache_control.split(",")}
+    return bool(directives & {"no-cache", "no-store"})
+
+
 def make_message_and_content_str(messages):
     """Converts a list of message objects into
     a string prompt and a concatenated string."""
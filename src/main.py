@@ -1,58 +1,445 @@
+import time
 import config
 import logging
 import languagemodels as lm
 
+from typing import Optional
+from functools import wraps
+from functools import partial
 from fastapi import FastAPI
+from fastapi import Header
+from fastapi import Query
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
+from fastapi.responses import PlainTextResponse
+from telemetry import metrics
+from telemetry import startup
+from telemetry import tracing
+from cache import SemanticCache
+from coalescing import SingleFlight
+from concurrency import AdaptiveConcurrencyLimiter
+from scheduling import OutputLengthPredictor
+from scheduling import Scheduler
+from ratelimit import SQLiteTokenBucketLimiter
+from ratelimit import TokenBucketLimiter
+from cancellation import RequestCancellation
+from cancellation import run_cancellable
+from cancellation import min_timeout
+from cancellation import wait_cancellable
 from exception import error_handling
 from model import CompletionQuery
 from model import CompletionResponse
 from model import ChatQuery
+from model import EmbeddingQuery
 from helpers import prefill_response
 from helpers import clean_completion
 from helpers import make_message_and_content_str
 from helpers import serialize_messages
+from helpers import is_cache_bypassed
+from helpers import make_embeddings_response
+from helpers import get_api_key
+from profiling import RequestProfile
+from profiling import RequestTimerMiddleware
+from profiling import TracingMiddleware
+from profiling import SlowRequestLog
+from profiling import is_profile_requested
+from profiling import sample_stacks
+from recording import TrafficRecorder
+from recording import TrafficRecorderMiddleware
 
 
+startup.record_elapsed("imports")
 app = FastAPI(title=config.get_app_title(),
-              description=config.get_app_description())
+              description=config.get_app_description(),
+              default_response_class=ORJSONResponse)
+app.add_middleware(RequestTimerMiddleware)
 artifact_tup = lm.get_preloaded_artifacts()
 model_name = lm.get_model_name()
 logger = config.get_logger(__name__)
 logger.info(f"Loaded '{model_name}' model into memory")
 
+tracing_config = config.get_tracing_config()
+if tracing_config.pop("enabled"):
+    tracing.configure(service_name=config.get_app_title(), **tracing_config)
+    app.add_middleware(TracingMiddleware)
+    app.add_event_handler("shutdown", tracing.shutdown)
+    logger.info(f"Enabled tracing to the {tracing_config['exporter']} "
+                "span exporter")
+
+recording_config = config.get_recording_config()
+traffic_recorder = None
+if recording_config.pop("enabled"):
+    traffic_recorder = TrafficRecorder(**recording_config)
+    app.add_middleware(TrafficRecorderMiddleware, recorder=traffic_recorder)
+    app.add_event_handler("shutdown", traffic_recorder.flush)
+    logger.info("Enabled traffic recording")
+
+cache_config = config.get_semantic_cache_config()
+semantic_cache = None
+if cache_config.pop("enabled"):
+    semantic_cache = SemanticCache(artifact_tup[0], **cache_config)
+    logger.info("Enabled semantic response cache")
+
+profiling_config = config.get_profiling_config()
+slow_requests = None
+if profiling_config.pop("enabled"):
+    slow_requests = SlowRequestLog(**profiling_config)
+    logger.info("Enabled slow request log and /debug endpoints")
+
+rate_limit_config = config.get_rate_limit_config()
+rate_limiter = None
+if rate_limit_config.pop("enabled"):
+    sqlite_path = rate_limit_config.pop("sqlite_path")
+    if sqlite_path:
+        rate_limiter = SQLiteTokenBucketLimiter(sqlite_path,
+                                                **rate_limit_config)
+    else:
+        rate_limiter = TokenBucketLimiter(**rate_limit_config)
+    logger.info("Enabled token rate limits per API key")
+
+concurrency_config = config.get_concurrency_config()
+concurrency_limiter = None
+if concurrency_config.pop("enabled"):
+    concurrency_limiter = AdaptiveConcurrencyLimiter(**concurrency_config)
+    logger.info("Enabled adaptive concurrency limit")
+
+scheduling_config = config.get_scheduling_config()
+scheduler = None
+length_predictor = OutputLengthPredictor(
+    default=lm.config["max_output_tokens"] / 2)
+if scheduling_config.pop("enabled"):
+    scheduler = Scheduler(**scheduling_config)
+    logger.info(f"Enabled {scheduler.policy} inference scheduling")
+
+single_flight = None
+if config.get_single_flight_config()["enabled"]:
+    single_flight = SingleFlight()
+    logger.info("Enabled coalescing of identical in-flight requests")
+
+startup_config = config.get_startup_config()
+if startup_config["warmup"]:
+    with startup.phase("warmup"):
+        lm.do("Hello", preloaded_artifacts=artifact_tup)
+logger.info(f"Startup timings: {startup.format_timings()}")
+
+
+def profile_first_request(func):
+    """Records the duration of the first request as a startup phase"""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if startup.is_recorded("first_request"):
+            return await func(*args, **kwargs)
+        with startup.phase("first_request"):
+            response = await func(*args, **kwargs)
+        logger.info(f"Startup timings: {startup.format_timings()}")
+        return response
+    return wrapper
+
+
+async def _cached_completion(namespace, prompt, cache_control,
+                             infer, details):
+    """Serves a completion from the semantic cache when
+    available, otherwise runs inference and stores it along
+    with its finish reason and dropped prompt tokens, which
+    are restored in the details of the requests it serves.
+    Partial completions of cancelled requests are not cached."""
+    if semantic_cache is None or is_cache_bypassed(cache_control):
+        return await infer()
+    fp = semantic_cache.fingerprint(namespace, prompt)
+    completion = semantic_cache.get(fp, details)
+    if completion is None:
+        completion = await infer()
+        if "cancelled" not in details.get("finish_reasons", []):
+            semantic_cache.put(fp, completion, {
+                k: details[k] for k in ["finish_reasons", "dropped_tokens"]
+                if k in details})
+    return completion
+
+
+def _coalesced(namespace, prompt, params, infer, details, wait):
+    """Shares the inference of identical in-flight requests, which
+    are keyed on the token ids of the prompt and the request params.
+    Only requests decoded greedily are deterministic enough for it.
+    Duplicates wait for the first request through `wait`."""
+    if single_flight is None:
+        return infer
+    ids = tuple(artifact_tup[0].encode(prompt).ids)
+    key = (model_name, namespace, ids, params)
+    return lambda: single_flight.run(key, infer, details, wait)
+
+
+async def _call_rate_limiter(method, *args):
+    # The SQLite limiter blocks whilst other workers hold its database
+    if rate_limiter.blocking:
+        return await run_in_threadpool(method, *args)
+    return method(*args)
+
+
+async def _acquire_tokens(api_key, texts, max_completion_tokens=0):
+    """Takes the prompt tokens and the maximum completion tokens of a
+    request from the bucket of its API key before inference is
+    scheduled. Raises a RateLimitExceededException if they exceed it."""
+    if rate_limiter is None:
+        return
+    encodings = artifact_tup[0].encode_batch(texts, add_special_tokens=False)
+    await _call_rate_limiter(
+        rate_limiter.acquire, api_key,
+        sum(len(e.ids) for e in encodings) + max_completion_tokens)
+
+
+async def _refund_tokens(api_key, completion_tokens):
+    """Returns the completion tokens that were reserved but not used,
+    which are all of them for requests that failed"""
+    if rate_limiter is not None:
+        await _call_rate_limiter(
+            rate_limiter.refund, api_key,
+            lm.config["max_output_tokens"] - completion_tokens)
+
+
+def _limited(infer, details):
+    """Runs inference within the adaptive concurrency limit, which
+    sheds the request with a 503 if too many calls are in flight.
+    The limit is updated from the latency per decoded token."""
+    if concurrency_limiter is None:
+        return infer
+
+    async def run():
+        concurrency_limiter.acquire()
+        start = time.perf_counter()
+        latency = None
+        try:
+            completion = await infer()
+            tokens = sum(details.get("output_tokens", []))
+            # Requests that decoded no tokens (e.g., restricted to
+            # choices) have no latency per token to learn from
+            if tokens and "cancelled" \
+                    not in details.get("finish_reasons", []):
+                latency = (time.perf_counter() - start) / tokens
+            return completion
+        finally:
+            concurrency_limiter.release(latency)
+    return run
+
+
+# Rough average of English text, used to estimate prompt lengths
+CHARS_PER_TOKEN = 4
+
+
+def _scheduled(endpoint, prompt, infer, details, profile, wait):
+    """Waits for an inference slot behind the requests of lower
+    predicted output length, and learns the output lengths of the
+    endpoint from the completions. The wait goes through `wait`."""
+    if scheduler is None:
+        return infer
+
+    async def run():
+        # Estimated from the characters rather than tokenized on the
+        # event loop, which is close enough for power-of-two buckets
+        prompt_tokens = len(prompt) // CHARS_PER_TOKEN
+        start = time.perf_counter()
+        async with scheduler.slot(
+                length_predictor.predict(endpoint, prompt_tokens), wait):
+            profile.record("scheduling", time.perf_counter() - start)
+            completion = await infer()
+        if "cancelled" not in details.get("finish_reasons", []):
+            length_predictor.observe(endpoint, prompt_tokens,
+                                     sum(details.get("output_tokens", [])))
+        return completion
+    return run
+
+
+def _get_finish_reason(details):
+    return details.get("finish_reasons", ["stop"])[0]
+
+
+def _get_dropped_tokens(details):
+    return details.get("dropped_tokens", [0])[0]
+
+
+def _start_profile(request):
+    profile = RequestProfile(request.scope.get("received_at"))
+    profile.mark("validation")
+    return profile
+
+
+def _finish_profile(profile, endpoint, query, response, details,
+                    x_profile):
+    """Attaches the timing breakdown to the response when requested
+    with the X-Profile header and logs sampled slow requests."""
+    profile.mark("response")
+    profile.update(details.get("timings", {}))
+    if is_profile_requested(x_profile):
+        response["profile"] = profile.as_dict()
+    if slow_requests is not None and slow_requests.is_sampled():
+        usage = response["usage"]
+        parameters = dict(details.get("parameters", {}),
+                          timeout=query.timeout,
+                          return_partial=query.return_partial,
+                          truncation=query.truncation)
+        slow_requests.add(profile.elapsed(), {
+            "id": response["id"],
+            "endpoint": endpoint,
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "finish_reason": _get_finish_reason(details),
+            "parameters": parameters,
+            **profile.as_dict()})
+
+
 @app.get("/health")
 async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return metrics.render()
+
+
+if slow_requests is not None:
+    @app.get("/debug/slow")
+    async def get_slow_requests():
+        return slow_requests.get()
+
+    @app.get("/debug/profile", response_class=PlainTextResponse)
+    async def get_profile(seconds: float = Query(5, gt=0, le=60),
+                          interval: float = Query(0.01, gt=0, le=1)):
+        """Samples the stacks of the running threads in the
+        collapsed format of py-spy and flamegraph.pl"""
+        return await run_in_threadpool(sample_stacks, seconds, interval)
+
+
 @app.post("/completions", response_model=CompletionResponse)
+@profile_first_request
 @error_handling
-async def completions(query: CompletionQuery):
+async def completions(query: CompletionQuery, request: Request,
+                      cache_control: Optional[str] = Header(None),
+                      x_request_timeout: Optional[float] = Header(None),
+                      x_profile: Optional[str] = Header(None),
+                      authorization: Optional[str] = Header(None),
+                      x_api_key: Optional[str] = Header(None)):
+    profile = _start_profile(request)
     logger.debug(query)
     prompt = query.prompt
-    completion = lm.do(prompt,
-                       preloaded_artifacts=artifact_tup)
-    completion = clean_completion(completion)
-    response = prefill_response(prompt, completion)
-    response["choices"] = [{"text": completion}]
-    return response
+    api_key = get_api_key(authorization, x_api_key)
+    await _acquire_tokens(api_key, [prompt], lm.config["max_output_tokens"])
+    completion_tokens = 0
+    try:
+        cancellation = RequestCancellation(
+            min_timeout(query.timeout, x_request_timeout))
+        details = dict()
+        wait = partial(wait_cancellable, request, cancellation)
+        # Both change the completion of a prompt, so they are cached apart
+        namespace = f"completions:{query.truncation}:{query.return_partial}"
+        endpoint = "completions:choices" if query.choices else "completions"
+        if query.choices:
+            namespace += ":" + "\x1f".join(query.choices)
+        # Completions are decoded greedily so identical requests coalesce
+        completion = await _cached_completion(
+            namespace, prompt, cache_control, _coalesced(
+                namespace, prompt, (query.truncation, query.return_partial),
+                _limited(_scheduled(endpoint, prompt, lambda: run_cancellable(
+                    request, cancellation, lm.do, prompt,
+                    choices=query.choices,
+                    preloaded_artifacts=artifact_tup,
+                    return_partial=query.return_partial,
+                    truncation=query.truncation,
+                    details=details, profile=profile), details, profile,
+                    wait),
+                    details),
+                details, wait),
+            details)
+        # Inference stages are recorded by the wrapper
+        profile.mark()
+        completion = clean_completion(completion)
+        response = prefill_response(prompt, completion, artifact_tup[0],
+                                    _get_dropped_tokens(details))
+        response["choices"] = [{
+            "text": completion,
+            "finish_reason": _get_finish_reason(details)}]
+        completion_tokens = response["usage"]["completion_tokens"]
+    finally:
+        await _refund_tokens(api_key, completion_tokens)
+    _finish_profile(profile, "completions", query, response, details,
+                    x_profile)
+    # The response is built by the wrapper so it is returned
+    # directly to skip the re-validation of response_model
+    return ORJSONResponse(response)
 
 
 @app.post("/chat/completions")
+@profile_first_request
 @error_handling
-async def chat(query: ChatQuery):
+async def chat(query: ChatQuery, request: Request,
+               cache_control: Optional[str] = Header(None),
+               x_request_timeout: Optional[float] = Header(None),
+               x_profile: Optional[str] = Header(None),
+               authorization: Optional[str] = Header(None),
+               x_api_key: Optional[str] = Header(None)):
+    profile = _start_profile(request)
     logger.debug(query)
     messages = query.messages
-    _, content_str = \
+    message_str, content_str = \
         make_message_and_content_str(messages)
-    messages_dict = serialize_messages(messages)
-    completion = lm.chat_from_dict(messages_dict,
-                                   preloaded_artifacts=artifact_tup)
-    completion = clean_completion(completion)
-    response = prefill_response(content_str, completion)
-    response["choices"] = [{
-        "message": {
-            "role": "assistant",
-            "content": completion
-        }}]
-    return response
+    api_key = get_api_key(authorization, x_api_key)
+    await _acquire_tokens(api_key, [content_str],
+                          lm.config["max_output_tokens"])
+    completion_tokens = 0
+    try:
+        messages_dict = serialize_messages(messages)
+        profile.mark("serialization")
+        cancellation = RequestCancellation(
+            min_timeout(query.timeout, x_request_timeout))
+        details = dict()
+        wait = partial(wait_cancellable, request, cancellation)
+        # Both change the completion of a prompt, so they are cached apart
+        namespace = f"chat:{query.truncation}:{query.return_partial}"
+        completion = await _cached_completion(
+            namespace, message_str, cache_control,
+            _limited(_scheduled("chat", content_str, lambda: run_cancellable(
+                request, cancellation, lm.chat_from_dict, messages_dict,
+                preloaded_artifacts=artifact_tup,
+                return_partial=query.return_partial,
+                truncation=query.truncation,
+                details=details, profile=profile), details, profile, wait),
+                details),
+            details)
+        # Inference stages are recorded by the wrapper
+        profile.mark()
+        completion = clean_completion(completion)
+        response = prefill_response(content_str, completion, artifact_tup[0],
+                                    _get_dropped_tokens(details))
+        response["choices"] = [{
+            "message": {
+                "role": "assistant",
+                "content": completion
+            },
+            "finish_reason": _get_finish_reason(details)}]
+        completion_tokens = response["usage"]["completion_tokens"]
+    finally:
+        await _refund_tokens(api_key, completion_tokens)
+    _finish_profile(profile, "chat", query, response, details, x_profile)
+    return ORJSONResponse(response)
+
+
+@app.post("/embeddings")
+@error_handling
+async def embeddings(query: EmbeddingQuery, request: Request,
+                     x_request_timeout: Optional[float] = Header(None),
+                     authorization: Optional[str] = Header(None),
+                     x_api_key: Optional[str] = Header(None)):
+    logger.debug(query)
+    texts = [query.input] if isinstance(query.input, str) else query.input
+    await _acquire_tokens(get_api_key(authorization, x_api_key), texts)
+    cancellation = RequestCancellation(
+        min_timeout(query.timeout, x_request_timeout))
+    details = dict()
+    vectors = await run_cancellable(request, cancellation, lm.embed, texts,
+                                    preloaded_artifacts=artifact_tup,
+                                    truncation=query.truncation,
+                                    details=details)
+    response = make_embeddings_response(vectors, details["tokens"],
+                                        query.encoding_format,
+                                        query.precision)
+    return ORJSONResponse(response)
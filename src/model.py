@@ -1,11 +1,25 @@
 from pydantic import BaseModel
 from pydantic import conlist
 from typing import List
+from typing import Literal
+from typing import Optional
+from typing import Union
 from enum import Enum
 
 
-class CompletionQuery(BaseModel):
+class BaseQuery(BaseModel):
+    # Seconds after which generation is aborted
+    timeout: Optional[float] = None
+    # Returns the tokens decoded so far when aborted
+    return_partial: bool = False
+
+
+class CompletionQuery(BaseQuery):
     prompt: str
+    # Truncates prompts over the input token budget
+    truncation: Optional[Literal["head", "tail", "middle"]] = None
+    # Restricts the completion to one of the choices
+    choices: Optional[conlist(str, min_length=1, max_length=1000)] = None
 
 
 class Role(str, Enum):
@@ -19,20 +33,36 @@ class RoleContentChat(BaseModel):
     content: str
 
 
-class ChatQuery(BaseModel):
+class ChatQuery(BaseQuery):
     # Defines a min and max length for 'messages'
     messages: conlist(
         RoleContentChat, min_length=1, max_length=5)
+    # Truncates prompts over the input token budget
+    truncation: Optional[Literal[
+        "head", "tail", "middle", "drop_oldest_turns"]] = None
+
+
+class EmbeddingQuery(BaseModel):
+    input: Union[str, conlist(str, min_length=1, max_length=2048)]
+    encoding_format: Literal["float", "base64"] = "float"
+    # Casts the embeddings to shrink the response payload
+    precision: Literal["float32", "float16", "int8"] = "float32"
+    # Truncates inputs over the input token budget
+    truncation: Optional[Literal["head", "tail", "middle"]] = None
+    # Seconds after which encoding is aborted
+    timeout: Optional[float] = None
 
 
 class UsageResponse(BaseModel):
     completion_tokens: int
     prompt_tokens: int
     total_tokens: int
+    dropped_prompt_tokens: int = 0
 
 
 class TextCompletion(BaseModel):
     text: str
+    finish_reason: Optional[str] = None
 
 
 class BaseResponse(BaseModel):
@@ -0,0 +1,144 @@
+import sys
+import time
+import heapq
+import random
+import itertools
+import threading
+
+from collections import Counter
+from telemetry import tracing
+
+
+class RequestTimerMiddleware:
+    """Stamps the time each request is received,
+    before its body is parsed and validated."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        scope["received_at"] = time.perf_counter()
+        await self.app(scope, receive, send)
+
+
+class TracingMiddleware:
+    """Traces each request as the root span of the spans
+    recorded whilst handling it (see telemetry.tracing)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with tracing.span(f"{scope['method']} {scope['path']}",
+                          **{"http.method": scope["method"],
+                             "http.target": scope["path"]}) as span:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.status_code",
+                                       message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+
+
+class RequestProfile:
+    """Per-stage timing breakdown of a request,
+    measured from the time it was received.
+    Marked stages are also traced as spans."""
+
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.perf_counter()
+        self.timings = {}
+        self._last_mark = self.start
+
+    def record(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    def mark(self, stage=None):
+        """Records the time since the previous mark as a stage,
+        or skips it (e.g., if it was recorded elsewhere)."""
+        now = time.perf_counter()
+        if stage is not None:
+            self.record(stage, now - self._last_mark)
+            tracing.record_span(stage, self._last_mark, now)
+        self._last_mark = now
+
+    def update(self, timings):
+        for stage, seconds in timings.items():
+            self.record(stage, seconds)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def as_dict(self):
+        return {
+            "total_ms": round(self.elapsed() * 1e3, 3),
+            "stages_ms": {k: round(v * 1e3, 3)
+                          for k, v in self.timings.items()},
+        }
+
+
+def is_profile_requested(x_profile):
+    """Checks whether the X-Profile header of
+    a request asks for a timing breakdown."""
+    return bool(x_profile) and x_profile.strip().lower() \
+        in ("1", "true", "yes", "on")
+
+
+class SlowRequestLog:
+    """Keeps the slowest of the sampled requests in a
+    bounded min-heap so that the fastest one is evicted
+    first once `capacity` entries are stored."""
+
+    def __init__(self, capacity=20, sample_rate=0.1):
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def is_sampled(self):
+        return random.random() < self.sample_rate
+
+    def add(self, elapsed, entry):
+        item = (elapsed, next(self._counter), entry)
+        with self._lock:
+            if len(self._heap) < self.capacity:
+                heapq.heappush(self._heap, item)
+            elif elapsed > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def get(self):
+        """Returns the entries from the slowest"""
+        with self._lock:
+            items = sorted(self._heap, reverse=True)
+        return [entry for _, _, entry in items]
+
+
+def _collapse_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} "
+                     f"({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_stacks(seconds, interval=0.01):
+    """Samples the stacks of all other threads for a number of
+    seconds. Returns their counts in the collapsed stack format
+    of py-spy and flamegraph.pl, one "stack count" per line."""
+    counts = Counter()
+    current = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != current:
+                counts[_collapse_stack(frame)] += 1
+        time.sleep(interval)
+    return "\n".join(f"{stack} {n}" for stack, n in counts.most_common())
@@ -0,0 +1,131 @@
+import math
+import time
+import sqlite3
+import threading
+
+from telemetry import metrics
+
+
+class RateLimitExceededException(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_retry_after_header(retry_after):
+    """Formats seconds as the integer value of a Retry-After header."""
+    return str(max(math.ceil(retry_after), 1))
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + max(now - updated, 0) * rate)
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets where the cost of a request is
+    measured in model tokens rather than in requests.
+
+    Each bucket holds up to `burst_tokens` and refills at
+    `tokens_per_second`. Keys can be given their own quotas
+    through `limits`, a dict of key to (rate, burst).
+
+    The buckets are only updated from the event loop and
+    without awaiting, so they need no locking."""
+
+    # Whether calls block and must be run off the event loop
+    blocking = False
+
+    def __init__(self, tokens_per_second, burst_tokens, limits=None,
+                 clock=time.monotonic):
+        self.tokens_per_second = tokens_per_second
+        self.burst_tokens = burst_tokens
+        self.limits = limits or dict()
+        self.clock = clock
+        self._buckets = dict()
+
+    def get_limits(self, key):
+        return self.limits.get(
+            key, (self.tokens_per_second, self.burst_tokens))
+
+    def _take(self, key, tokens, updated, now, cost):
+        """Returns the tokens left after taking the cost
+        or raises if the bucket does not hold enough."""
+        rate, burst = self.get_limits(key)
+        tokens = _refill(tokens, updated, now, rate, burst)
+        if cost > burst:
+            metrics.increment("rate_limited_requests_total")
+            raise RateLimitExceededException(
+                f"Request costs {cost} tokens whilst the "
+                f"limit is {burst:g} tokens")
+        if cost > tokens:
+            metrics.increment("rate_limited_requests_total")
+            raise RateLimitExceededException(
+                f"Rate limit of {rate:g} tokens per second exceeded",
+                retry_after=(cost - tokens) / rate)
+        return tokens - cost
+
+    def acquire(self, key, cost):
+        """Takes cost tokens from the bucket of a key"""
+        now = self.clock()
+        tokens, updated = self._buckets.get(
+            key, (self.get_limits(key)[1], now))
+        self._buckets[key] = (self._take(key, tokens, updated, now, cost),
+                              now)
+
+    def refund(self, key, tokens):
+        """Returns unused tokens (e.g., of a completion shorter
+        than the maximum) to the bucket of a key"""
+        if key in self._buckets and tokens > 0:
+            left, updated = self._buckets[key]
+            burst = self.get_limits(key)[1]
+            self._buckets[key] = (min(left + tokens, burst), updated)
+
+
+class SQLiteTokenBucketLimiter(TokenBucketLimiter):
+    """Token buckets stored in a local SQLite file so that
+    the limits are shared by the workers of a host. Buckets
+    are updated in immediate transactions and refilled using
+    the wall clock, which is shared across processes. Waiting
+    for the transactions of other workers blocks, so calls are
+    run in the thread pool and serialised on the connection."""
+
+    blocking = True
+
+    def __init__(self, path, tokens_per_second, burst_tokens, limits=None):
+        super().__init__(tokens_per_second, burst_tokens, limits,
+                         clock=time.time)
+        self._connection = sqlite3.connect(
+            path, timeout=5, isolation_level=None,
+            check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS buckets "
+            "(key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+
+    def _update(self, key, update):
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                row = cursor.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?",
+                    (key,)).fetchone()
+                now = self.clock()
+                tokens, updated = row or (self.get_limits(key)[1], now)
+                cursor.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                    (key, *update(tokens, updated, now)))
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def acquire(self, key, cost):
+        self._update(key, lambda tokens, updated, now: (
+            self._take(key, tokens, updated, now, cost), now))
+
+    def refund(self, key, tokens):
+        if tokens > 0:
+            burst = self.get_limits(key)[1]
+            self._update(key, lambda left, updated, now: (
+                min(left + tokens, burst), updated))
@@ -0,0 +1,135 @@
+"""Recording of sampled requests for replay
+
+The body and arrival time of sampled POST requests are appended to a
+gzip-compressed JSONL log, in blocks of `flush_every` requests so that
+each block compresses well. Blocks are compressed and written by a
+worker thread, off the event loop, with a single append, so the workers
+of a host can share a log. The text of the `redact` fields of the
+bodies (at any depth, including every string nested in them) is masked
+whilst keeping its length and word boundaries, which keeps token counts
+close to the original ones.
+
+>>> redact({"prompt": "Call Ann at 555-0199", "max_tokens": 5}, ["prompt"])
+{'prompt': 'xxxx xxx xx 000-0000', 'max_tokens': 5}
+>>> redact({"input": ["Hi Ann", {"text": "Bye"}]}, ["input"])
+{'input': ['xx xxx', {'text': 'xxx'}]}
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import random
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def _redact_text(text):
+    return re.sub(r"\d", "0", re.sub(r"[^\W\d_]", "x", text))
+
+
+def _redact_all(value):
+    if isinstance(value, str):
+        return _redact_text(value)
+    if isinstance(value, dict):
+        return {k: _redact_all(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact_all(v) for v in value]
+    return value
+
+
+def redact(value, fields):
+    """Masks the strings of the given fields of a JSON value"""
+    if isinstance(value, dict):
+        return {k: _redact_all(v) if k in fields else redact(v, fields)
+                for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v, fields) for v in value]
+    return value
+
+
+class TrafficRecorder:
+    def __init__(self, path, sample_rate=1.0, redact=(), flush_every=64):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.redact = set(redact)
+        self.flush_every = flush_every
+        self._buffer = []
+        self._lock = threading.Lock()
+        # A single thread keeps the blocks in order
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+
+    def is_sampled(self):
+        return random.random() < self.sample_rate
+
+    def record(self, received_at, path, body):
+        """Buffers a request received at `received_at` (epoch
+        seconds) and hands the buffer to the writer once it is full"""
+        try:
+            body = redact(json.loads(body), self.redact)
+        except ValueError:
+            body = None
+        entry = {"t": received_at, "path": path, "body": body}
+        with self._lock:
+            self._buffer.append(json.dumps(entry) + "\n")
+            if len(self._buffer) < self.flush_every:
+                return
+            lines, self._buffer = self._buffer, []
+            self._pending = self._writer.submit(self._write, lines)
+
+    def flush(self):
+        """Writes the buffer and waits for the pending writes"""
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+            if lines:
+                self._pending = self._writer.submit(self._write, lines)
+            pending = self._pending
+        if pending is not None:
+            pending.result()
+
+    def _write(self, lines):
+        block = gzip.compress("".join(lines).encode())
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, block)
+        finally:
+            os.close(fd)
+
+
+class TrafficRecorderMiddleware:
+    """Records the body of sampled POST requests once
+    it has been received by the application."""
+
+    def __init__(self, app, recorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" \
+                or not self.recorder.is_sampled():
+            await self.app(scope, receive, send)
+            return
+
+        received_at = time.time()
+        chunks = []
+
+        async def receive_and_record():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    self.recorder.record(received_at, scope["path"],
+                                         b"".join(chunks))
+            return message
+
+        await self.app(scope, receive_and_record, send)
+
+
+def read_log(path):
+    """Returns the entries of a traffic log sorted by arrival"""
+    with gzip.open(path, "rt") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda e: e["t"])
@@ -0,0 +1,149 @@
+"""Replay of recorded traffic against a server
+
+Re-sends the requests of a traffic log (see `recording`) at their
+recorded offsets from the first request, scaled by `speed` (a speed of
+2 halves the gaps, and 0 sends requests as fast as `concurrency`
+allows), and reports latency and throughput, e.g.:
+
+python src/replay.py traffic.jsonl.gz --url http://localhost:8000 \
+    --speed 1 --report new.json --baseline old.json
+
+Latencies of timed replays are measured from the scheduled send time,
+so that requests delayed by a saturated client or server still count.
+
+>>> get_schedule([{"t": 10.0}, {"t": 10.5}, {"t": 12.0}], speed=2)
+[0.0, 0.25, 1.0]
+>>> percentile([0.1, 0.2, 0.3, 0.4], 0.5)
+0.3
+"""
+
+import sys
+import json
+import time
+import httpx
+import asyncio
+import argparse
+
+from collections import Counter
+from recording import read_log
+
+
+METRICS = ["throughput_rps", "latency_mean_ms", "latency_p50_ms",
+           "latency_p90_ms", "latency_p99_ms", "latency_max_ms"]
+
+
+def get_schedule(entries, speed):
+    """Returns the send time of each entry from the start of the replay"""
+    if not entries or not speed:
+        return [0.0] * len(entries)
+    return [(e["t"] - entries[0]["t"]) / speed for e in entries]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of sorted values"""
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def replay(entries, send, speed=1.0, concurrency=64):
+    """Sends the entries with `send(path, body)`, a coroutine that
+    returns the status code of the response, and returns the latency
+    and status of each request and the duration of the replay"""
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    async def run(offset, entry):
+        await asyncio.sleep(max(start + offset - time.perf_counter(), 0))
+        async with semaphore:
+            sent = time.perf_counter() if not speed else start + offset
+            try:
+                status = await send(entry["path"], entry["body"])
+            except httpx.HTTPError:
+                status = 0
+            return time.perf_counter() - sent, status
+
+    results = await asyncio.gather(*(
+        run(offset, entry)
+        for offset, entry in zip(get_schedule(entries, speed), entries)))
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed, label=None):
+    """Builds the report of a replay, where the latencies only cover
+    successful requests and failed connections have status 0"""
+    latencies = sorted(latency for latency, status in results
+                       if status == 200)
+    report = {
+        "label": label,
+        "requests": len(results),
+        "statuses": dict(Counter(str(status) for _, status in results)),
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / max(elapsed, 1e-9), 3),
+    }
+    if latencies:
+        report.update({
+            "latency_mean_ms": sum(latencies) / len(latencies),
+            "latency_p50_ms": percentile(latencies, 0.5),
+            "latency_p90_ms": percentile(latencies, 0.9),
+            "latency_p99_ms": percentile(latencies, 0.99),
+            "latency_max_ms": latencies[-1],
+        })
+        for k in METRICS[1:]:
+            report[k] = round(report[k] * 1e3, 3)
+    return report
+
+
+def compare(baseline, report):
+    """Formats the change of each metric from a baseline report"""
+    lines = [f"{'metric':<18}{baseline['label'] or 'baseline':>14}"
+             f"{report['label'] or 'current':>14}{'change':>10}"]
+    for k in METRICS:
+        if k not in baseline or k not in report:
+            continue
+        change = (report[k] - baseline[k]) / baseline[k] * 100 \
+            if baseline[k] else 0
+        lines.append(f"{k:<18}{baseline[k]:>14.3f}{report[k]:>14.3f}"
+                     f"{change:>+9.1f}%")
+    return "\n".join(lines)
+
+
+async def _replay_log(args):
+    entries = read_log(args.log)
+    headers = {"X-API-Key": args.api_key} if args.api_key else {}
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, headers=headers,
+                                 limits=limits, timeout=None) as client:
+        async def send(path, body):
+            return (await client.post(path, json=body)).status_code
+        return await replay(entries, send, args.speed, args.concurrency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replays a traffic log against a server")
+    parser.add_argument("log", help="Traffic log recorded by the server")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Speed-up of the recorded arrival times, "
+                        "or 0 to send requests as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="Maximum number of requests in flight")
+    parser.add_argument("--api-key", help="Sent as X-API-Key")
+    parser.add_argument("--label", help="Name of the build or "
+                        "configuration under test")
+    parser.add_argument("--report", help="Writes the report to a file")
+    parser.add_argument("--baseline", help="Report to compare against")
+    args = parser.parse_args(argv)
+
+    results, elapsed = asyncio.run(_replay_log(args))
+    report = summarize(results, elapsed, args.label)
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(json.load(f), report))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
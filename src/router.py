@@ -0,0 +1,235 @@
+"""Cache-affinity router in front of replicas of the service
+
+Requests are consistent-hashed onto the backends by their session id
+(the X-Session-Id header) or else by the prefix of their prompt, so
+that requests sharing a prompt prefix or a session reach the replica
+whose caches already hold it. It does not load the model and runs as:
+
+ROUTER_BACKENDS=http://localhost:8001,http://localhost:8002 \
+    uvicorn --app-dir src router:app --port 8000
+
+Backends failing to accept connections or their health checks are
+ejected for `ejection_seconds`, and their keys move to the next
+backends on the ring until they are healthy again. Other errors (e.g.,
+a slow response) fail the request with a 502, or a 504 on timeouts,
+but do not eject the backend, which may only be busy.
+"""
+
+import json
+import math
+import time
+import httpx
+import bisect
+import asyncio
+import hashlib
+import config
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from telemetry import metrics
+
+
+# Set by the client or the server for each hop
+HOP_HEADERS = {"host", "connection", "content-length", "content-encoding",
+               "transfer-encoding", "keep-alive"}
+
+
+def _hash(key):
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing with bounded loads
+
+    Each backend is placed at `virtual_nodes` points of the ring. A key
+    goes to the first backend clockwise from its hash that is available
+    and has fewer than `load_factor` times the average number of
+    requests in flight (rounded up), so that popular keys spill over
+    to the next backends instead of overloading theirs.
+
+    >>> ring = HashRing(["a", "b", "c"])
+    >>> backend = ring.get("session-1")
+    >>> ring.get("session-1") == backend
+    True
+    >>> ring.loads[backend] = 2
+    >>> ring.get("session-1") == backend
+    False
+    """
+
+    def __init__(self, backends, virtual_nodes=100, load_factor=1.25):
+        self.backends = list(backends)
+        self.load_factor = load_factor
+        self.loads = dict.fromkeys(self.backends, 0)
+        points = sorted((_hash(f"{b}#{i}"), b)
+                        for b in self.backends for i in range(virtual_nodes))
+        self._hashes = [h for h, _ in points]
+        self._points = [b for _, b in points]
+
+    def get(self, key, available=None):
+        """Returns the backend of a key among the available
+        ones (all by default), or None if there are none"""
+        candidates = set(self.backends if available is None else available)
+        if not candidates:
+            return None
+        total = sum(self.loads[b] for b in candidates)
+        capacity = math.ceil(self.load_factor * (total + 1)
+                             / len(candidates))
+        start = bisect.bisect(self._hashes, _hash(key))
+        for i in range(len(self._points)):
+            backend = self._points[(start + i) % len(self._points)]
+            if backend in candidates and self.loads[backend] < capacity:
+                return backend
+        return None
+
+
+class Router:
+    def __init__(self, backends, client, virtual_nodes=100,
+                 load_factor=1.25, prefix_chars=256, ejection_seconds=10):
+        self.ring = HashRing(backends, virtual_nodes, load_factor)
+        self.client = client
+        self.prefix_chars = prefix_chars
+        self.ejection_seconds = ejection_seconds
+        self._ejected_until = {}
+
+    def get_available(self):
+        now = time.monotonic()
+        return [b for b in self.ring.backends
+                if self._ejected_until.get(b, 0) <= now]
+
+    def eject(self, backend):
+        self._ejected_until[backend] = \
+            time.monotonic() + self.ejection_seconds
+        metrics.increment("router_ejections_total", backend=backend)
+        metrics.set_gauge("router_backend_healthy", 0, backend=backend)
+
+    def restore(self, backend):
+        self._ejected_until.pop(backend, None)
+        metrics.set_gauge("router_backend_healthy", 1, backend=backend)
+
+    def get_key(self, headers, body):
+        """Returns the session id of a request or else the
+        prefix of its prompt, chat messages or input"""
+        if headers.get("x-session-id"):
+            return "session:" + headers["x-session-id"]
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return ""
+        if not isinstance(data, dict):
+            return ""
+        if isinstance(data.get("messages"), list):
+            text = "\n".join(str(m.get("content", ""))
+                             for m in data["messages"]
+                             if isinstance(m, dict))
+        else:
+            text = str(data.get("prompt") or data.get("input") or "")
+        return "prefix:" + text[:self.prefix_chars]
+
+    async def forward(self, request):
+        """Proxies a request to the backend of its key. Requests
+        that could not connect are retried on the next backends."""
+        body = await request.body()
+        key = self.get_key(request.headers, body)
+        headers = {k: v for k, v in request.headers.items()
+                   if k not in HOP_HEADERS}
+        tried = set()
+        while True:
+            backend = self.ring.get(key, [b for b in self.get_available()
+                                          if b not in tried])
+            if backend is None:
+                return ORJSONResponse(
+                    {"detail": "No healthy backend available"},
+                    status_code=503, headers={"Retry-After": "1"})
+            self.ring.loads[backend] += 1
+            try:
+                response = await self.client.request(
+                    request.method, backend + request.url.path,
+                    params=request.query_params, content=body,
+                    headers=headers)
+            except httpx.ConnectError:
+                # The request did not reach the backend, so it is safe
+                # to retry even if it is not idempotent
+                self.eject(backend)
+                tried.add(backend)
+                continue
+            except httpx.TransportError as e:
+                # The request may have been processed, so it is not
+                # retried, and health checks eject failing backends
+                metrics.increment("router_backend_errors_total",
+                                  backend=backend)
+                status_code = 504 \
+                    if isinstance(e, httpx.TimeoutException) else 502
+                return ORJSONResponse({"detail": f"Backend error: {e!r}"},
+                                      status_code=status_code)
+            finally:
+                self.ring.loads[backend] -= 1
+            metrics.increment("routed_requests_total", backend=backend)
+            return Response(response.content, response.status_code,
+                            headers={k: v for k, v
+                                     in response.headers.items()
+                                     if k not in HOP_HEADERS})
+
+    async def check_health(self):
+        """Ejects the backends failing their health
+        check and restores the passing ones"""
+        async def check(backend):
+            try:
+                response = await self.client.get(backend + "/health")
+                return response.status_code == 200
+            except httpx.HTTPError:
+                return False
+
+        results = await asyncio.gather(*map(check, self.ring.backends))
+        for backend, healthy in zip(self.ring.backends, results):
+            if healthy:
+                self.restore(backend)
+            elif self._ejected_until.get(backend, 0) <= time.monotonic():
+                self.eject(backend)
+
+    async def run_health_checks(self, interval):
+        while True:
+            await self.check_health()
+            await asyncio.sleep(interval)
+
+
+router_config = config.get_router_config()
+health_interval = router_config.pop("health_interval")
+router = Router(client=httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=router_config.pop("max_connections")),
+    timeout=router_config.pop("timeout")), **router_config)
+app = FastAPI(title=f"{config.get_app_title()} router",
+              default_response_class=ORJSONResponse)
+logger = config.get_logger(__name__)
+logger.info(f"Routing to {len(router.ring.backends)} backends")
+_tasks = set()
+
+
+async def _start_health_checks():
+    _tasks.add(asyncio.create_task(router.run_health_checks(health_interval)))
+
+
+async def _stop():
+    for task in _tasks:
+        task.cancel()
+    await router.client.aclose()
+
+
+app.add_event_handler("startup", _start_health_checks)
+app.add_event_handler("shutdown", _stop)
+
+
+@app.get("/health")
+async def root():
+    return {"message": "Hello World",
+            "backends": router.get_available()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return metrics.render()
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST"])
+async def proxy(request: Request):
+    return await router.forward(request)
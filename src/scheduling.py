@@ -0,0 +1,130 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+from contextlib import asynccontextmanager
+from telemetry import metrics
+
+
+POLICIES = ["spjf", "fifo"]
+
+
+class OutputLengthPredictor:
+    """Predicts the output tokens of a request from its endpoint
+    and the number of tokens of its prompt.
+
+    Output lengths are averaged with exponential weights per endpoint
+    and per power-of-two bucket of prompt tokens, so that similar
+    prompts share their statistics. Buckets with fewer than
+    `min_samples` observations fall back to the average of their
+    endpoint, and unseen endpoints to `default`.
+
+    >>> predictor = OutputLengthPredictor(default=64, min_samples=2)
+    >>> predictor.predict("chat", 30)
+    64
+    >>> for _ in range(2):
+    ...     predictor.observe("completions:choices", 30, 0)
+    >>> predictor.predict("completions:choices", 20)
+    0.0
+    """
+
+    def __init__(self, default=64, smoothing=0.1, min_samples=5):
+        self.default = default
+        self.smoothing = smoothing
+        self.min_samples = min_samples
+        self._stats = dict()
+
+    def _update(self, key, value):
+        count, mean = self._stats.get(key, (0, 0.0))
+        # Plain average until the exponential weights take over
+        weight = max(1 / (count + 1), self.smoothing)
+        self._stats[key] = (count + 1, mean + weight * (value - mean))
+
+    def observe(self, endpoint, prompt_tokens, output_tokens):
+        self._update(endpoint, output_tokens)
+        self._update((endpoint, prompt_tokens.bit_length()), output_tokens)
+
+    def predict(self, endpoint, prompt_tokens):
+        for key in [(endpoint, prompt_tokens.bit_length()), endpoint]:
+            count, mean = self._stats.get(key, (0, 0.0))
+            if count >= self.min_samples:
+                return mean
+        return self.default
+
+
+class Scheduler:
+    """Admits requests to a fixed number of inference slots
+
+    Waiting requests are served in the order of their predicted cost
+    (shortest predicted job first), which minimises the mean latency
+    under mixed load, or in their order of arrival with the "fifo"
+    policy. To prevent starvation, waiting lowers the cost of a request
+    by `aging` per second, so a request waits at most about
+    cost / `aging` seconds for later requests to overtake it. Since
+    every waiting request ages at the same rate, the order only depends
+    on `cost + aging * arrival`, which is fixed once queued.
+    """
+
+    def __init__(self, slots=1, policy="spjf", aging=50,
+                 clock=time.monotonic):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        self.policy = policy
+        self.aging = aging
+        self.clock = clock
+        self._free = slots
+        self._queue = []
+        self._counter = itertools.count()
+
+    def _get_priority(self, cost, arrival):
+        if self.policy == "fifo":
+            return arrival
+        return cost + self.aging * arrival
+
+    async def _acquire(self, cost):
+        if self._free and not self._queue:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (
+            self._get_priority(cost, self.clock()),
+            next(self._counter), future))
+        metrics.set_gauge("scheduler_queue_length", len(self._queue))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over before the cancellation
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._queue = [e for e in self._queue if e[2] is not future]
+                heapq.heapify(self._queue)
+                metrics.set_gauge("scheduler_queue_length", len(self._queue))
+            raise
+
+    def _release(self):
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                metrics.set_gauge("scheduler_queue_length",
+                                  len(self._queue))
+                future.set_result(None)
+                return
+        self._free += 1
+        metrics.set_gauge("scheduler_queue_length", 0)
+
+    @asynccontextmanager
+    async def slot(self, cost, wait=None):
+        """Waits for a slot for a request of a predicted cost. The wait
+        goes through `wait` if set, which bounds it (e.g., by the
+        deadline of the request) and raises when it is exceeded."""
+        start = time.perf_counter()
+        acquire = self._acquire(cost)
+        await (wait(acquire) if wait is not None else acquire)
+        metrics.increment("scheduler_wait_seconds_total",
+                          time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            self._release()
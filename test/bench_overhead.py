@@ -0,0 +1,45 @@
+"""Benchmark of the per-request overhead of the wrapper
+
+The Translator is replaced by a stub without any simulated latency,
+so that the timings only include the framework overhead
+(validation, tokenization, response building and serialisation)."""
+import time
+import main
+import logging
+
+from fastapi.testclient import TestClient
+from languagemodels.stub import StubTranslator
+
+
+N_REQUESTS = 500
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def time_requests(client, path, request, n=N_REQUESTS):
+    start = time.perf_counter()
+    for _ in range(n):
+        response = client.post(path, json=request)
+        assert response.status_code == 200
+    return (time.perf_counter() - start) / n
+
+
+main.artifact_tup = (main.artifact_tup[0],
+                     StubTranslator(token_latency=0, input_token_latency=0))
+client = TestClient(main.app)
+
+completion_request = {
+    "prompt": "What is the name of the biggest planet in the solar system?"
+}
+chat_request = {
+    "messages": [
+        {"role": "system", "content": "Respond in one word."},
+        {"role": "user", "content": "What is the biggest planet?"}
+    ]
+}
+
+for path, request in [("/completions", completion_request),
+                      ("/chat/completions", chat_request)]:
+    time_requests(client, path, request, n=10)
+    elapsed = time_requests(client, path, request)
+    print(f"{path}: {elapsed * 1e6:.0f} us per request "
+          f"({N_REQUESTS} requests)")
@@ -0,0 +1,60 @@
+"""Benchmark of CPU-pinned model replicas
+
+Loads the model as replicas over groups of CPUs, first pinned to their
+group and then unpinned (same replicas and threads, but free to migrate
+across sockets), and compares their throughput under concurrent load.
+The number of replicas defaults to the number of NUMA nodes, e.g.:
+
+LLM_ARTIFACT_DIR=artifacts/model python test/bench_replicas.py 2
+"""
+import sys
+import time
+import threading
+
+from languagemodels import replicas
+from languagemodels.backends import generate_batch, load_model
+from languagemodels.bootstrap import get_artifact_dir
+from languagemodels.models import get_model_info, get_tokenizer
+
+
+N_REQUESTS = 64
+CLIENTS_PER_REPLICA = 2
+PROMPT = "Write a short story about the biggest planet in the solar system."
+
+
+def run(pool, tokens, n_clients):
+    counts = []
+    lock = threading.Lock()
+
+    def client(n):
+        for _ in range(n):
+            output = generate_batch(pool, [tokens], [[]], 128)[0]
+            with lock:
+                counts.append(len(output))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client,
+                                args=(N_REQUESTS // n_clients,))
+               for _ in range(n_clients)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    return sum(counts) / (time.perf_counter() - start)
+
+
+artifact_dir = get_artifact_dir()
+model_info = get_model_info()
+count = int(sys.argv[1]) if len(sys.argv) > 1 else max(
+    len(replicas.get_numa_nodes()), 2)
+groups = replicas.get_cpu_groups(count)
+tokens = get_tokenizer(artifact_dir).encode(PROMPT).tokens
+print(f"CPU groups: {groups}")
+
+for pin in [True, False]:
+    pool = replicas.load_replicas(
+        lambda threads: load_model(artifact_dir, model_info,
+                                   intra_threads=threads), groups, pin=pin)
+    run(pool, tokens, len(groups))  # Warm up
+    throughput = run(pool, tokens, len(groups) * CLIENTS_PER_REPLICA)
+    label = "Pinned" if pin else "Unpinned"
+    print(f"{label}: {throughput:.1f} tokens/s")
+    del pool
@@ -0,0 +1,75 @@
+"""Benchmark of the inference scheduling policies
+
+Replays the same mixed load of short classification requests (with
+choices) and long open-ended completions against the stub backend with
+the FIFO and the shortest predicted job first policies, and reports
+their mean and p99 latency. A traffic log recorded by the server can
+be replayed instead by passing its path, in which case the model set
+by LLM_ARTIFACT_DIR is used.
+
+LLM_BACKEND=stub LLM_ARTIFACT_DIR= python test/bench_scheduling.py
+"""
+import sys
+import httpx
+import random
+import asyncio
+import logging
+import main
+
+from languagemodels.stub import StubTranslator
+from recording import read_log
+from replay import replay, summarize
+from scheduling import OutputLengthPredictor, Scheduler
+
+
+N_REQUESTS = 200
+# Arrivals per second, about 80% of the capacity of the stub below
+RATE = 18
+SHORT_SHARE = 0.7
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def make_entries(seed=0):
+    rng = random.Random(seed)
+    entries, t = [], 0.0
+    for i in range(N_REQUESTS):
+        t += rng.expovariate(RATE)
+        if rng.random() < SHORT_SHARE:
+            body = {"prompt": f"Is review {i} positive or negative?",
+                    "choices": ["positive", "negative"]}
+        else:
+            body = {"prompt": f"Write a long story about topic {i}."}
+        entries.append({"t": t, "path": "/completions", "body": body})
+    return entries
+
+
+async def run(entries, speed=1.0):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, timeout=None,
+                                 base_url="http://bench") as client:
+        async def send(path, body):
+            return (await client.post(path, json=body)).status_code
+        return await replay(entries, send, speed)
+
+
+if len(sys.argv) > 1:
+    entries = read_log(sys.argv[1])
+else:
+    entries = make_entries()
+    main.artifact_tup = (main.artifact_tup[0], StubTranslator(
+        token_latency=0.002, input_token_latency=0, max_output_tokens=128))
+
+# Completions are not cached nor coalesced so that every request runs
+main.semantic_cache = main.single_flight = None
+main.length_predictor = OutputLengthPredictor(
+    default=main.lm.config["max_output_tokens"] / 2)
+main.scheduler = Scheduler(policy="fifo")
+# Teaches the predictor the output lengths of the endpoints
+asyncio.run(run(make_entries(seed=1)[:50], speed=0))
+
+for policy in ["fifo", "spjf"]:
+    main.scheduler = Scheduler(policy=policy)
+    report = summarize(*asyncio.run(run(entries)), label=policy)
+    print(f"{policy}: mean {report['latency_mean_ms']:.1f} ms, "
+          f"p99 {report['latency_p99_ms']:.1f} ms, "
+          f"{report['throughput_rps']:.1f} requests/s")
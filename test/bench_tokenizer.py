@@ -0,0 +1,33 @@
+"""Benchmark of the tokenizer loading cost
+
+Measures the time to load the tokenizer, the latency of counting
+the tokens of a prompt and the peak RSS of the process. Point
+LLM_ARTIFACT_DIR to the model artifacts before running it, e.g.:
+
+LLM_ARTIFACT_DIR=artifacts/model python test/bench_tokenizer.py
+"""
+import time
+import resource
+import languagemodels as lm
+
+from languagemodels.bootstrap import get_artifact_dir
+from languagemodels.models import get_tokenizer
+
+
+N_COUNTS = 100
+
+
+def get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+start = time.perf_counter()
+get_tokenizer(get_artifact_dir())
+print(f"Tokenizer load: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+start = time.perf_counter()
+for _ in range(N_COUNTS):
+    lm.count_tokens("What is the name of the biggest planet?")
+elapsed = (time.perf_counter() - start) / N_COUNTS
+print(f"count_tokens: {elapsed * 1e3:.2f} ms per call ({N_COUNTS} calls)")
+print(f"Peak RSS: {get_peak_rss_mb():.0f} MB")
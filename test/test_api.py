@@ -11,6 +11,12 @@ def test_health():
     assert response.json() == {"message": "Hello World"}
 
 
+def test_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+
 def test_completions():
     request = {
         "prompt": "What's the first name of the secret agent Bond?"
@@ -25,6 +31,17 @@ def test_completions():
     assert "james" in res_json["choices"][0]["text"].lower()
 
 
+def test_completions_deadline_expired():
+    """Expecting a 504 status raised from
+    a DeadlineExceededException."""
+    request = {
+        "prompt": "What's the first name of the secret agent Bond?",
+        "timeout": 0
+    }
+    response = client.post("/completions", json=request)
+    assert response.status_code == 504
+
+
 def test_chat_simple():
     request = {
         "messages": [
@@ -109,3 +126,18 @@ def test_chat_max_tokens():
     }
     response = client.post("/chat/completions", json=request)
     assert response.status_code == 400
+
+
+def test_chat_truncation():
+    request = {
+        "messages": [
+            {
+                "role": "user",
+                "content": "Hi "*500
+            }
+        ],
+        "truncation": "head"
+    }
+    response = client.post("/chat/completions", json=request)
+    assert response.status_code == 200
+    assert response.json()["usage"]["dropped_prompt_tokens"] > 0
@@ -23,6 +23,10 @@ for module_tup in modules:
         submodule_name = f"{module_str}.{module_tup[0]}"
         test_modules.append(
             _get_module_by_string_lookup(submodule_name))
+# Modules shared with the wrapper outside of the package
+for submodule_name in ["metrics", "startup", "tracing"]:
+    test_modules.append(
+        _get_module_by_string_lookup(f"telemetry.{submodule_name}"))
 print(f"Modules to be tested: {test_modules}")
 
 for module in test_modules:
@@ -1,3 +1,4 @@
+import pytest
 import languagemodels as lm
 
 from tokenizers import Tokenizer
@@ -5,6 +6,15 @@ from ctranslate2._ext import Translator
 from helpers import make_message_and_content_str
 from helpers import is_primitive_strict
 from helpers import serialize_messages
+from helpers import is_cache_bypassed
+from helpers import prefill_response
+from cache import SemanticCache
+from cancellation import RequestCancellation
+from cancellation import min_timeout
+from languagemodels.inference import DeadlineExceededException
+from languagemodels.inference import MaxTokensException
+from languagemodels.inference import generate
+from languagemodels.inference import drop_oldest_turns
 from model import Role
 from model import RoleContentChat
 from utils import time_function
@@ -126,3 +136,116 @@ def test_message_serialisation():
     expected_serial = [{'role': 'user', 'content': 'Foo'},
                        {'role': 'system', 'content': 'Bar'}]
     assert messages_serial == expected_serial
+
+
+def test_semantic_cache_near_duplicate():
+    cache = SemanticCache(artifact_tup[0], threshold=0.8)
+    fp = cache.fingerprint("completions", completion_query)
+    assert cache.get(fp) is None
+    cache.put(fp, "Jupiter.")
+    near_duplicate = "what is the name of the biggest " \
+        "planet in the  solar system?"
+    assert cache.get(cache.fingerprint(
+        "completions", near_duplicate)) == "Jupiter."
+    assert cache.get(cache.fingerprint(
+        "chat", near_duplicate)) is None
+    assert cache.get(cache.fingerprint(
+        "completions", "Tell me two songs by Radiohead")) is None
+
+
+def test_semantic_cache_keeps_operators():
+    cache = SemanticCache(artifact_tup[0])
+    assert cache.canonicalise("What is  2+2?") \
+        == cache.canonicalise("what is 2+2?")
+    assert cache.canonicalise("What is 2+2?") \
+        != cache.canonicalise("What is 2*2?")
+
+
+def test_semantic_cache_eviction():
+    cache = SemanticCache(artifact_tup[0], max_bytes=4000)
+    for i in range(20):
+        fp = cache.fingerprint("completions", f"Prompt number {i}")
+        cache.put(fp, "Completion.")
+    assert 0 < cache.size_bytes <= 4000
+    assert cache.get(cache.fingerprint(
+        "completions", "Prompt number 0")) is None
+
+
+def test_is_cache_bypassed():
+    assert is_cache_bypassed("no-cache") is True
+    assert is_cache_bypassed("max-age=0, No-Store") is True
+    assert is_cache_bypassed("max-age=0") is False
+    assert is_cache_bypassed(None) is False
+
+
+def test_completions_cancelled_before_inference():
+    with pytest.raises(DeadlineExceededException):
+        lm.do(completion_query,
+              preloaded_artifacts=artifact_tup,
+              should_stop=lambda: True)
+
+
+def test_completions_partial_result():
+    calls = []
+
+    def should_stop():
+        calls.append(None)
+        return len(calls) > 3
+
+    details = dict()
+    res = lm.do("Write a long story about a dragon",
+                preloaded_artifacts=artifact_tup,
+                should_stop=should_stop,
+                return_partial=True,
+                details=details)
+    assert isinstance(res, str)
+    assert details["finish_reasons"] == ["cancelled"]
+
+
+def test_request_cancellation():
+    assert min_timeout(None, 5.0, 2.0) == 2.0
+    assert min_timeout(None, None) is None
+    assert RequestCancellation().should_stop() is False
+    assert RequestCancellation(0).should_stop() is True
+
+
+def test_separate_input_budget():
+    with pytest.raises(MaxTokensException):
+        generate([completion_query], max_tokens=200, max_input_tokens=5,
+                 preloaded_artifacts=artifact_tup)
+
+
+def test_finish_reason_length():
+    details = dict()
+    generate(["Write a long story about a dragon"], max_tokens=3,
+             max_input_tokens=200, preloaded_artifacts=artifact_tup,
+             details=details)
+    assert details["finish_reasons"] == ["length"]
+
+
+def test_truncation_reports_dropped_tokens():
+    details = dict()
+    generate([completion_query], max_input_tokens=8, truncation="head",
+             preloaded_artifacts=artifact_tup, details=details)
+    assert details["dropped_tokens"] == [6]
+
+
+def test_drop_oldest_turns():
+    messages = [{"role": "system", "content": "Respond in one word."},
+                {"role": "assistant", "content": "Hello " * 50},
+                {"role": "user", "content": "What color is the sky?"}]
+    remaining, dropped = drop_oldest_turns(messages, artifact_tup[0], 20)
+    assert remaining == [messages[0], messages[2]]
+    assert dropped == 50
+
+
+def test_prefill_response():
+    response = prefill_response(completion_query, "Jupiter.",
+                                artifact_tup[0])
+    assert response["usage"]["prompt_tokens"] == \
+        lm.count_tokens(completion_query)
+    assert response["usage"]["completion_tokens"] == \
+        lm.count_tokens("Jupiter.")
+    other_response = prefill_response(completion_query, "Jupiter.",
+                                      artifact_tup[0])
+    assert response["id"] != other_response["id"]
@@ -0,0 +1,858 @@
+"""Tests of the wrapper against the stub backend. These
+tests run without any model artifacts as follows:
+
+LLM_BACKEND=stub LLM_ARTIFACT_DIR= pytest test/test_stub.py
+"""
+import os
+import sys
+import time
+import httpx
+import asyncio
+import json
+import pytest
+import base64
+import config
+import numpy as np
+import threading
+import subprocess
+import main
+import router
+import languagemodels as lm
+
+from functools import partial
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from languagemodels import backends
+from languagemodels import batch
+from telemetry import metrics
+from languagemodels import replicas
+from languagemodels import repetition
+from languagemodels import scoring
+from telemetry import startup
+from telemetry import tracing
+from languagemodels.encoder_cache import encoder_outputs
+from languagemodels.inference import DeadlineExceededException
+from languagemodels.constrained import TokenTrie
+from languagemodels.constrained import decode_choices
+from languagemodels.stub import StubGenerator
+from languagemodels.stub import StubTokenizer
+from languagemodels.stub import StubTranslator
+from main import app
+from cache import SemanticCache
+from coalescing import SingleFlight
+from cancellation import RequestCancellation
+from cancellation import wait_cancellable
+from concurrency import AdaptiveConcurrencyLimiter
+from concurrency import OverloadedException
+from ratelimit import RateLimitExceededException
+from router import HashRing
+from router import Router
+from ratelimit import SQLiteTokenBucketLimiter
+from ratelimit import TokenBucketLimiter
+from scheduling import OutputLengthPredictor
+from scheduling import Scheduler
+from profiling import SlowRequestLog
+from profiling import sample_stacks
+from recording import TrafficRecorder
+from recording import TrafficRecorderMiddleware
+from recording import read_log
+from replay import replay
+from replay import summarize
+
+client = TestClient(app)
+
+completion_request = {
+    "prompt": "What is the name of the biggest planet in the solar system?"
+}
+
+
+def test_load_stub_artifacts():
+    tokenizer, model = lm.get_preloaded_artifacts()
+    assert isinstance(tokenizer, StubTokenizer)
+    assert isinstance(model, StubTranslator)
+    assert lm.load_tokenizer() is tokenizer
+
+
+def test_completions_deterministic():
+    response = client.post("/completions", json=completion_request)
+    assert response.status_code == 200
+    other_response = client.post("/completions", json=completion_request)
+    assert response.json()["choices"] == other_response.json()["choices"]
+    assert response.json()["choices"][0]["finish_reason"] == "stop"
+
+
+def test_completions_partial_result():
+    request = dict(completion_request, timeout=0.02, return_partial=True)
+    response = client.post("/completions", json=request)
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["finish_reason"] == "cancelled"
+
+
+def test_chat_drop_oldest_turns():
+    request = {
+        "messages": [
+            {"role": "system", "content": "Respond in one word."},
+            {"role": "assistant", "content": "Hello " * 300},
+            {"role": "user", "content": "What's the first name of Bond?"}
+        ],
+        "truncation": "drop_oldest_turns"
+    }
+    response = client.post("/chat/completions", json=request)
+    assert response.status_code == 200
+    assert response.json()["usage"]["dropped_prompt_tokens"] == 300
+
+
+def test_stub_batch_scaling():
+    translator = StubTranslator(token_latency=0.002, batch_scaling=0.1)
+    source = [["▁Hello", "▁world", "</s>"]]
+    start = time.perf_counter()
+    translator.translate_batch(source, max_decoding_length=20)
+    single = time.perf_counter() - start
+    start = time.perf_counter()
+    translator.translate_batch(source * 8, max_decoding_length=20)
+    batched = time.perf_counter() - start
+    assert single < batched < 8 * single
+
+
+def test_generator_backend():
+    tokenizer = StubTokenizer()
+    translator = StubTranslator(token_latency=0)
+    generator = StubGenerator(token_latency=0)
+    prompt = completion_request["prompt"]
+    assert lm.do(prompt, preloaded_artifacts=(tokenizer, generator)) == \
+        lm.do(prompt, preloaded_artifacts=(tokenizer, translator))
+
+    source = [tokenizer.encode(prompt).tokens]
+    target = [["▁Jupiter", "."]]
+    assert len(backends.score_batch(generator, source, target)[0]) == 2
+    assert len(backends.score_batch(translator, source, target)[0]) == 3
+
+
+def test_startup_budget():
+    client.post("/completions", json=completion_request)
+    timings = startup.get_timings()
+    for phase in ["imports", "config", "tokenizer", "model",
+                  "first_request"]:
+        assert phase in timings
+    budgets = config.get_startup_config()["budget_seconds"]
+    assert startup.get_exceeded_phases(budgets) == []
+    response = client.get("/metrics")
+    assert 'startup_phase_seconds{phase="model"}' in response.text
+    # Later loads of the model at runtime are not startup phases
+    lm.models.get_artifacts(None, lm.models.get_model_info())
+    assert startup.get_timings()["model"] == timings["model"]
+
+
+def test_profile_header():
+    response = client.post("/completions", json=completion_request,
+                           headers={"X-Profile": "1"})
+    profile = response.json()["profile"]
+    for stage in ["validation", "queueing", "tokenization", "inference",
+                  "detokenization", "response"]:
+        assert stage in profile["stages_ms"]
+    assert sum(profile["stages_ms"].values()) <= profile["total_ms"]
+    response = client.post("/completions", json=completion_request)
+    assert "profile" not in response.json()
+
+
+def test_slow_request_log():
+    slow_requests = SlowRequestLog(capacity=2, sample_rate=1)
+    for elapsed in [0.3, 0.1, 0.5, 0.2]:
+        slow_requests.add(elapsed, {"total_ms": elapsed * 1e3})
+    assert slow_requests.get() == [{"total_ms": 500}, {"total_ms": 300}]
+
+
+def test_sample_stacks():
+    thread = threading.Thread(target=time.sleep, args=(0.2,))
+    thread.start()
+    stacks = sample_stacks(0.05)
+    thread.join()
+    assert "threading.py" in stacks
+
+
+def test_rank_instruct_top_k():
+    tokenizer = StubTokenizer()
+    translator = StubTranslator(token_latency=0)
+    artifacts = (tokenizer, translator)
+    inputs = ["six please", "seven please"]
+    labels = [f"label {i}" for i in range(50)] + ["six please",
+                                                  "seven please"]
+    ranks = lm.rank_instruct(inputs, labels, preloaded_artifacts=artifacts)
+    assert [r[0] for r in ranks] == inputs
+    top = lm.rank_instruct(inputs, labels, k=3,
+                           preloaded_artifacts=artifacts)
+    assert top == [r[:3] for r in ranks]
+
+    in_tok = [tokenizer.encode(i).tokens for i in inputs]
+    label_tok = [tokenizer.encode(t).tokens for t in labels]
+    scores = scoring.score_labels(translator, in_tok, label_tok)
+    assert scores.shape == (2, 52)
+    # Sub-batches under a token cap give the same scores
+    capped = scoring.score_labels(translator, in_tok, label_tok,
+                                  max_batch_tokens=20)
+    assert (scores == capped).all()
+    normalized = scoring.score_labels(translator, in_tok, label_tok,
+                                      normalize=True)
+    assert (normalized > scores).all()
+
+
+def test_constrained_choices():
+    request = dict(completion_request, prompt="seven please",
+                   choices=["six please", "seven please", "seven"])
+    response = client.post("/completions", json=request)
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["text"] == "seven please"
+
+
+def test_constrained_decoding_calls():
+    tokenizer = StubTokenizer()
+    translator = StubTranslator(token_latency=0)
+    calls = []
+    score_batch = translator.score_batch
+    translator.score_batch = lambda *a, **k: calls.append(1) or \
+        score_batch(*a, **k)
+
+    labels = [f"intent {i}" for i in range(100)]
+    trie = TokenTrie([tokenizer.encode(t, add_special_tokens=False).tokens
+                      for t in labels])
+    sources = [tokenizer.encode(p).tokens for p in ["Hi", "intent 42"]]
+    indices = decode_choices(translator, sources, trie)
+    assert labels[indices[1]] == "intent 42"
+    # A single branching point after the shared first token
+    assert len(calls) == 1
+
+
+def test_constrained_choices_cancelled():
+    tokenizer = StubTokenizer()
+    translator = StubTranslator(token_latency=0)
+    choices = ["six please", "seven please"]
+    polls = []
+
+    def should_stop():
+        # Stop after the check before inference
+        polls.append(1)
+        return len(polls) > 1
+
+    artifacts = (tokenizer, translator)
+    with pytest.raises(DeadlineExceededException):
+        lm.generate(["seven please"], choices=choices,
+                    preloaded_artifacts=artifacts,
+                    should_stop=should_stop)
+    polls.clear()
+    details = {}
+    assert lm.generate(
+        ["seven please"], choices=choices, preloaded_artifacts=artifacts,
+        should_stop=should_stop, return_partial=True,
+        details=details) == [""]
+    assert details["finish_reasons"] == ["cancelled"]
+
+
+def test_embeddings():
+    texts = ["Hello world", "A longer sentence about the solar system",
+             "Hi"]
+    response = client.post("/embeddings", json={"input": texts})
+    assert response.status_code == 200
+    data = response.json()["data"]
+    vectors = np.array([d["embedding"] for d in data])
+    assert vectors.shape == (3, 64)
+    # Sorting by length for batching keeps the order of the inputs
+    single = client.post("/embeddings", json={"input": "Hi"}).json()
+    assert np.allclose(vectors[2], single["data"][0]["embedding"])
+
+    request = {"input": texts, "encoding_format": "base64",
+               "precision": "int8"}
+    data = client.post("/embeddings", json=request).json()["data"]
+    quantized = np.array([np.frombuffer(base64.b64decode(d["embedding"]),
+                                        dtype=np.int8) * d["scale"]
+                          for d in data])
+    assert np.allclose(quantized, vectors, atol=0.02)
+
+
+def test_embeddings_too_long():
+    response = client.post("/embeddings", json={"input": "Hi " * 300})
+    assert response.status_code == 413
+    response = client.post("/embeddings", json={"input": "Hi " * 300,
+                                                "truncation": "tail"})
+    assert response.json()["usage"]["prompt_tokens"] == 250
+
+
+def test_encoder_cache():
+    tokenizer = StubTokenizer()
+    context = "A long context document about the solar system " * 10
+    encoder_outputs.max_bytes = 2 ** 20
+    try:
+        vectors = lm.embed([context, "Hi"],
+                           preloaded_artifacts=(tokenizer, None))
+        hits = metrics.get_value("encoder_cache_hits_total")
+        cached = lm.embed([context], preloaded_artifacts=(tokenizer, None))
+    finally:
+        encoder_outputs.max_bytes = 0
+    assert metrics.get_value("encoder_cache_hits_total") == hits + 1
+    assert metrics.get_value("encoder_cache_saved_seconds_total") > 0
+    assert np.allclose(cached[0], vectors[0])
+    # Only the pooled vector of each text is kept
+    assert encoder_outputs.get(tuple(tokenizer.encode("Hi").tokens)).shape \
+        == vectors[1].shape
+
+
+def test_context_static_prompt():
+    tokenizer = StubTokenizer()
+    generator = StubGenerator(token_latency=0)
+    static_prompts, cached = [], []
+    generate_batch = generator.generate_batch
+    generator.generate_batch = lambda *a, **k: \
+        static_prompts.append(k["static_prompt"]) or \
+        cached.append(k["cache_static_prompt"]) or generate_batch(*a, **k)
+    context = "There is a green ball and a red box"
+    for question in ["What color is the ball?", "What color is the box?"]:
+        lm.extract_answer(question, context,
+                          preloaded_artifacts=(tokenizer, generator))
+    assert static_prompts[0] == static_prompts[1] == \
+        tokenizer.encode(context, add_special_tokens=False).tokens
+    # The model state after a context of a request is not cached
+    assert cached == [False, False]
+
+
+def test_semantic_cache_details():
+    semantic_cache = main.semantic_cache
+    main.semantic_cache = SemanticCache(StubTokenizer())
+
+    async def infer():
+        details.update(finish_reasons=["length"], dropped_tokens=[3])
+        return "Jupiter"
+
+    details = {}
+    try:
+        asyncio.run(main._cached_completion(
+            "completions", "Biggest planet?", None, infer, details))
+        hit = {}
+        assert asyncio.run(main._cached_completion(
+            "completions", "biggest  planet?", None, infer, hit)) \
+            == "Jupiter"
+        assert hit == {"finish_reasons": ["length"], "dropped_tokens": [3]}
+        # Chats truncated differently are cached apart
+        request = {"messages": [{"role": "user", "content": "Hi"}]}
+        for truncation in [None, "drop_oldest_turns"]:
+            response = client.post("/chat/completions",
+                                   json=dict(request, truncation=truncation))
+            assert response.status_code == 200
+        assert len(main.semantic_cache._entries) == 3
+    finally:
+        main.semantic_cache = semantic_cache
+
+
+def test_single_flight():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def infer():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "Jupiter"
+
+    async def run_requests(n):
+        details = [dict() for _ in range(n)]
+        results = await asyncio.gather(*[
+            single_flight.run("key", infer, d) for d in details])
+        return results, details
+
+    coalesced = metrics.get_value("coalesced_requests_total")
+    results, details = asyncio.run(run_requests(5))
+    assert results == ["Jupiter"] * 5
+    assert len(calls) == 1 and len(single_flight) == 0
+    assert metrics.get_value("coalesced_requests_total") == coalesced + 4
+
+
+def test_single_flight_fallback():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ValueError()
+
+    async def infer():
+        return "Jupiter"
+
+    async def run_requests():
+        return await asyncio.gather(single_flight.run("key", fail, {}),
+                                    single_flight.run("key", infer, {}),
+                                    return_exceptions=True)
+
+    results = asyncio.run(run_requests())
+    assert isinstance(results[0], ValueError)
+    assert results[1] == "Jupiter"
+
+
+class ConnectedRequest:
+    async def is_disconnected(self):
+        return False
+
+
+def test_single_flight_follower_deadline():
+    single_flight = SingleFlight()
+
+    async def infer():
+        await asyncio.sleep(0.2)
+        return "Jupiter"
+
+    async def run_requests():
+        wait = partial(wait_cancellable, ConnectedRequest(),
+                       RequestCancellation(timeout=0.05))
+        leader = asyncio.create_task(single_flight.run("key", infer, {}))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        with pytest.raises(DeadlineExceededException):
+            await single_flight.run("key", infer, {}, wait)
+        assert time.perf_counter() - start < 0.15
+        # The first request is not cancelled by its duplicate
+        return await leader
+
+    assert asyncio.run(run_requests()) == "Jupiter"
+
+
+def test_token_bucket_limiter():
+    now = [0.0]
+    limiter = TokenBucketLimiter(10, 100, limits={"heavy": (1, 10)},
+                                 clock=lambda: now[0])
+    limiter.acquire("a", 80)
+    with pytest.raises(RateLimitExceededException) as e:
+        limiter.acquire("a", 50)
+    assert e.value.retry_after == 3
+    now[0] = 3
+    limiter.acquire("a", 50)
+    limiter.refund("a", 20)
+    limiter.acquire("a", 20)
+    with pytest.raises(RateLimitExceededException) as e:
+        limiter.acquire("heavy", 11)
+    assert e.value.retry_after is None
+
+
+def test_sqlite_limiter_is_shared(tmp_path):
+    path = str(tmp_path / "buckets.db")
+    limiters = [SQLiteTokenBucketLimiter(path, 0.001, 100)
+                for _ in range(2)]
+    limiters[0].acquire("a", 60)
+    with pytest.raises(RateLimitExceededException) as e:
+        limiters[1].acquire("a", 60)
+    assert e.value.retry_after > 0
+    limiters[1].acquire("b", 60)
+
+
+def test_rate_limited_request():
+    rate_limiter = main.rate_limiter
+    main.rate_limiter = TokenBucketLimiter(1, 500)
+    # Costs the 200 prompt tokens and the maximum completion tokens
+    request = {"prompt": "word " * 200}
+    try:
+        headers = {"Authorization": "Bearer test"}
+        response = client.post("/completions", json=request,
+                               headers=headers)
+        assert response.status_code == 200
+        response = client.post("/completions", json=request,
+                               headers=headers)
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 0
+        response = client.post("/completions", json=request,
+                               headers={"X-API-Key": "other"})
+        assert response.status_code == 200
+    finally:
+        main.rate_limiter = rate_limiter
+
+
+def test_failed_request_is_refunded(tmp_path):
+    rate_limiter = main.rate_limiter
+    concurrency_limiter = main.concurrency_limiter
+    max_tokens = lm.config["max_output_tokens"]
+    # Only holds the maximum completion tokens of one request
+    main.rate_limiter = SQLiteTokenBucketLimiter(
+        str(tmp_path / "buckets.db"), 0.001, max_tokens + 100)
+    main.concurrency_limiter = AdaptiveConcurrencyLimiter()
+    main.concurrency_limiter.in_flight = 1
+    request = {"prompt": "word " * 30}
+    try:
+        response = client.post("/completions", json=request)
+        assert response.status_code == 503
+        main.concurrency_limiter.in_flight = 0
+        response = client.post("/completions", json=request)
+        assert response.status_code == 200
+    finally:
+        main.rate_limiter = rate_limiter
+        main.concurrency_limiter = concurrency_limiter
+
+
+def test_adaptive_concurrency_limit():
+    limiter = AdaptiveConcurrencyLimiter()
+    limits, shed = [], 0
+    for _ in range(100):
+        # 32 clients send a request each, and the admitted ones
+        # complete together. Four calls run in parallel before the
+        # latency per token grows with contention.
+        admitted = 0
+        for _ in range(32):
+            try:
+                limiter.acquire()
+                admitted += 1
+            except OverloadedException:
+                shed += 1
+        latency = 0.002 * max(1, admitted / 4)
+        for _ in range(admitted):
+            limiter.release(latency)
+            limits.append(limiter.limit)
+    assert shed and limiter.in_flight == 0
+    settled = limits[len(limits) // 2:]
+    assert 4 <= min(settled) and max(settled) <= 16
+
+
+def test_choices_do_not_update_concurrency_limit():
+    concurrency_limiter = main.concurrency_limiter
+    main.concurrency_limiter = AdaptiveConcurrencyLimiter()
+    try:
+        response = client.post("/completions", json={
+            "prompt": "Is it red?", "choices": ["yes", "no"]})
+        assert response.status_code == 200
+        assert main.concurrency_limiter.min_latency is None
+        response = client.post("/completions", json={"prompt": "Hi"})
+        assert main.concurrency_limiter.min_latency is not None
+    finally:
+        main.concurrency_limiter = concurrency_limiter
+
+
+def test_overloaded_request():
+    concurrency_limiter = main.concurrency_limiter
+    main.concurrency_limiter = AdaptiveConcurrencyLimiter()
+    main.concurrency_limiter.in_flight = 1
+    try:
+        response = client.post("/completions", json={"prompt": "Hi"})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        main.concurrency_limiter.in_flight = 0
+        response = client.post("/completions", json={"prompt": "Hi"})
+        assert response.status_code == 200
+        assert main.concurrency_limiter.in_flight == 0
+    finally:
+        main.concurrency_limiter = concurrency_limiter
+
+
+def test_replica_pool():
+    groups = replicas.get_cpu_groups(2)
+    affinity = os.sched_getaffinity(0)
+    cpus = []
+    pool = replicas.load_replicas(
+        lambda threads: cpus.append(os.sched_getaffinity(0)) or
+        StubTranslator(token_latency=0.01), groups)
+    assert os.sched_getaffinity(0) == affinity
+    assert cpus == [set(g) for g in groups]
+    assert backends.is_generator(pool) is False
+
+    # Concurrent calls are spread over the replicas
+    translated = []
+    for replica in pool.replicas:
+        translate_batch = replica.translate_batch
+        replica.translate_batch = lambda *args, r=replica, f=translate_batch, \
+            **kwargs: translated.append(r) or f(*args, **kwargs)
+    threads = [threading.Thread(target=backends.generate_batch,
+                                args=(pool, [["▁Hi"]], [[]], 10))
+               for _ in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(translated) == 4
+    assert len(set(map(id, translated))) == len(groups)
+
+
+def test_batch_resume(tmp_path):
+    records = [{"id": i, "prompt": "word " * (i % 5 + 1)} for i in range(9)]
+    records += [{"messages": [{"role": "user", "content": "Hi"}]}, {}]
+    input_path = tmp_path / "input.jsonl"
+    input_path.write_text("".join(json.dumps(r) + "\n" for r in records))
+    output_path = tmp_path / "output.jsonl"
+
+    progress = batch.run(input_path, output_path, batch_size=2,
+                         window_size=4)
+    assert progress.records == 11 and progress.errors == 1
+    expected = output_path.read_text()
+    results = [json.loads(line) for line in expected.splitlines()]
+    assert [r["id"] for r in results] == list(range(11))
+    assert all("completion" in r for r in results[:10])
+
+    # An interrupted run is resumed after its last complete line
+    lines = expected.splitlines(keepends=True)
+    output_path.write_text("".join(lines[:5]) + lines[5][:10])
+    progress = batch.run(input_path, output_path, batch_size=2,
+                         window_size=4, resume=True)
+    assert progress.skipped == 5 and progress.records == 6
+    assert output_path.read_text() == expected
+
+
+def test_record_and_replay(tmp_path):
+    path = str(tmp_path / "traffic.jsonl.gz")
+    recorder = TrafficRecorder(path, redact=["prompt", "input"],
+                               flush_every=2)
+    recording_client = TestClient(TrafficRecorderMiddleware(app, recorder))
+    for prompt in ["Say 1234", "Say hi", "Say bye"]:
+        response = recording_client.post("/completions",
+                                         json={"prompt": prompt})
+        assert response.status_code == 200
+    recording_client.post("/embeddings", json={"input": ["Hi", "Bye"]})
+    recording_client.get("/health")
+    recorder.flush()
+
+    entries = read_log(path)
+    assert [e["body"]["prompt"] for e in entries[:3]] == \
+        ["xxx 0000", "xxx xx", "xxx xxx"]
+    assert entries[0]["path"] == "/completions"
+    assert entries[3]["body"]["input"] == ["xx", "xxx"]
+
+    async def replay_entries():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url="http://test") as client:
+            async def send(path, body):
+                return (await client.post(path, json=body)).status_code
+            return await replay(entries, send, speed=0)
+
+    results, elapsed = asyncio.run(replay_entries())
+    report = summarize(results, elapsed, label="stub")
+    assert report["requests"] == 4
+    assert report["statuses"] == {"200": 4}
+    assert report["latency_p50_ms"] <= report["latency_max_ms"]
+
+
+def test_tracing_off():
+    assert not tracing.is_enabled()
+    with tracing.span("inference") as span:
+        assert span is None
+    tracing.record_span("inference", 0, 1)
+
+
+def test_tracing_spans(tmp_path):
+    pytest.importorskip("opentelemetry.sdk")
+    path = str(tmp_path / "spans.jsonl")
+    tracing.configure("file", path=path)
+    try:
+        traced_client = TestClient(main.TracingMiddleware(app))
+        response = traced_client.post("/completions",
+                                      json={"prompt": "Say hi"})
+        assert response.status_code == 200
+    finally:
+        tracing.shutdown()
+
+    with open(path) as f:
+        spans = {s["name"]: s for s in map(json.loads, f)}
+    for name in ["validation", "queueing", "tokenization",
+                 "translate_batch", "detokenization", "response"]:
+        assert spans[name]["parent_id"] is not None
+    assert spans["translate_batch"]["attributes"]["batch_size"] == 1
+    assert spans["POST /completions"]["attributes"]["http.status_code"] \
+        == 200
+
+
+def test_hash_ring_bounded_loads():
+    ring = HashRing([f"http://replica{i}" for i in range(4)])
+    keys = [f"session:{i}" for i in range(1000)]
+    counts = {}
+    for key in keys:
+        backend = ring.get(key)
+        ring.loads[backend] += 1
+        counts[backend] = counts.get(backend, 0) + 1
+    assert max(counts.values()) <= 1.25 * len(keys) / 4 + 1
+
+    # Removing a backend only moves its own keys
+    ring = HashRing(ring.backends)
+    before = {key: ring.get(key) for key in keys}
+    available = ring.backends[1:]
+    for key in keys:
+        if before[key] != ring.backends[0]:
+            assert ring.get(key, available) == before[key]
+
+
+def test_router():
+    def make_backend(name):
+        backend = FastAPI()
+
+        @backend.get("/health")
+        async def health():
+            return {}
+
+        @backend.post("/completions")
+        async def completions(request: Request):
+            body = await request.json()
+            return {"backend": name, "prompt": body["prompt"]}
+        return backend
+
+    def refuse(request):
+        raise httpx.ConnectError("Connection refused", request=request)
+
+    backends = ["http://a", "http://b", "http://down"]
+    transports = {"http://a": httpx.ASGITransport(app=make_backend("a")),
+                  "http://b": httpx.ASGITransport(app=make_backend("b")),
+                  "http://down": httpx.MockTransport(refuse)}
+    default_router = router.router
+    router.router = Router(backends, httpx.AsyncClient(mounts=transports))
+
+    async def send_requests():
+        transport = httpx.ASGITransport(app=router.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url="http://router") as client:
+            responses = []
+            for i in range(20):
+                responses.append(await client.post(
+                    "/completions", json={"prompt": f"Say {i % 5}"}))
+            await router.router.check_health()
+            health = (await client.get("/health")).json()
+            return responses, health
+
+    try:
+        responses, health = asyncio.run(send_requests())
+    finally:
+        router.router = default_router
+    assert all(r.status_code == 200 for r in responses)
+    # Requests with the same prompt prefix reach the same backend
+    backend_of = {}
+    for r in responses:
+        body = r.json()
+        assert backend_of.setdefault(body["prompt"], body["backend"]) \
+            == body["backend"]
+    assert len(set(backend_of.values())) == 2
+    assert health["backends"] == ["http://a", "http://b"]
+
+
+def test_router_imports_without_artifacts():
+    env = {k: v for k, v in os.environ.items()
+           if k not in ("LLM_ARTIFACT_DIR", "LLM_BACKEND")}
+    env["ROUTER_BACKENDS"] = "http://localhost:8001"
+    env["PYTHONPATH"] = os.pathsep.join([
+        os.path.dirname(router.__file__),
+        os.path.dirname(os.path.dirname(lm.__file__))])
+    # The router does not load the model, nor its bootstrap config
+    subprocess.run([sys.executable, "-c",
+                    "import sys, router; "
+                    "assert 'languagemodels' not in sys.modules"],
+                   env=env, check=True)
+
+
+def test_router_backend_errors():
+    def fail(request):
+        if request.url.path == "/health":
+            return httpx.Response(200)
+        if request.url.host == "slow":
+            raise httpx.ReadTimeout("Timed out", request=request)
+        raise httpx.RemoteProtocolError("Disconnected", request=request)
+
+    backends = ["http://slow", "http://broken"]
+    transport = httpx.MockTransport(fail)
+
+    async def send_requests():
+        routes = Router(backends, httpx.AsyncClient(transport=transport))
+        statuses = {}
+        for i in range(20):
+            request = Request({
+                "type": "http", "method": "POST",
+                "path": "/completions", "query_string": b"",
+                "headers": [(b"x-session-id", str(i).encode())]})
+            request._body = b"{}"
+            backend = routes.ring.get("session:" + str(i))
+            response = await routes.forward(request)
+            statuses[backend] = response.status_code
+        return statuses, routes.get_available()
+
+    statuses, available = asyncio.run(send_requests())
+    assert statuses == {"http://slow": 504, "http://broken": 502}
+    # Neither backend refused the connection, so both stay available
+    assert available == backends
+
+
+def test_repetition_loops():
+    assert repetition.find_loop(["▁no"] * 11) is None
+    assert repetition.find_loop(["▁no"] * 12) == (0, 1)
+
+    artifacts = (StubTokenizer(), StubTranslator(token_latency=0,
+                                                 max_output_tokens=64))
+    # The stub cycles through the prompt, so only the short one is a loop
+    prompts = ["Say yes no", " ".join(f"w{i}" for i in range(40))]
+    lm.config["stop_repetition_loops"] = True
+    details, prefixed = {}, {}
+    loops = metrics.get_value("repetition_loops_total")
+    try:
+        results = lm.generate(prompts, max_tokens=64,
+                              preloaded_artifacts=artifacts,
+                              details=details)
+        # The steps of the target prefix are not checked for loops
+        lm.generate(prompts[1:], max_tokens=96, prefix="no " * 12,
+                    preloaded_artifacts=artifacts, details=prefixed)
+    finally:
+        lm.config["stop_repetition_loops"] = False
+    assert results[0] == "Say yes no"
+    assert details["finish_reasons"][0] == "repetition"
+    assert details["finish_reasons"][1] != "repetition"
+    assert prefixed["finish_reasons"] == ["stop"]
+    assert metrics.get_value("repetition_loops_total") == loops + 1
+
+
+def test_scheduler_order():
+    async def schedule(policy, jobs):
+        now = [0.0]
+        scheduler = Scheduler(slots=1, policy=policy, aging=1,
+                              clock=lambda: now[0])
+        order = []
+
+        async def run(name, cost):
+            async with scheduler.slot(cost):
+                order.append(name)
+                await asyncio.sleep(0)
+
+        blocker = asyncio.Event()
+
+        async def block():
+            async with scheduler.slot(0):
+                await blocker.wait()
+
+        tasks = [asyncio.create_task(block())]
+        await asyncio.sleep(0)
+        for name, cost, arrival in jobs:
+            now[0] = arrival
+            tasks.append(asyncio.create_task(run(name, cost)))
+            await asyncio.sleep(0)
+        blocker.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    jobs = [("long", 100, 0), ("short", 5, 1), ("medium", 50, 2)]
+    assert asyncio.run(schedule("fifo", jobs)) == ["long", "short", "medium"]
+    assert asyncio.run(schedule("spjf", jobs)) == ["short", "medium", "long"]
+    # A long job that waited for long enough is not overtaken anymore
+    jobs = [("long", 100, 0), ("short", 5, 96)]
+    assert asyncio.run(schedule("spjf", jobs)) == ["long", "short"]
+
+
+def test_scheduler_wait_deadline():
+    async def schedule():
+        scheduler = Scheduler(slots=1)
+        wait = partial(wait_cancellable, ConnectedRequest(),
+                       RequestCancellation(timeout=0.05))
+        async with scheduler.slot(0):
+            with pytest.raises(DeadlineExceededException):
+                async with scheduler.slot(0, wait):
+                    pass
+            # The expired request does not hold a place in the queue
+            assert scheduler._queue == []
+        async with scheduler.slot(0, wait=None):
+            return scheduler._free
+
+    assert asyncio.run(schedule()) == 0
+
+
+def test_scheduled_request():
+    length_predictor = main.length_predictor
+    main.length_predictor = OutputLengthPredictor(default=-1, min_samples=2)
+    main.scheduler = Scheduler()
+    try:
+        for _ in range(2):
+            response = client.post("/completions", json={"prompt": "Hi"},
+                                   headers={"X-Profile": "1"})
+            assert response.status_code == 200
+        assert "scheduling" in response.json()["profile"]["stages_ms"]
+        assert main.length_predictor.predict("completions", 0) > 0
+        assert main.length_predictor.predict("chat", 0) == -1
+    finally:
+        main.scheduler = None
+        main.length_predictor = length_predictor